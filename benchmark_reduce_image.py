@@ -0,0 +1,262 @@
+# By @Oscar-gg
+
+# Benchmark for ImageReduction: generates a reproducible synthetic site
+# (jpg photos, flat png graphics, animated gifs, nested folders) and times
+# each entry point. Besides the imports used by reduce_image.py, it uses
+# numpy, resource (only available in linux / mac), contextlib and queue.
+
+class ImageReductionBenchmark:
+
+  def __init__(self, corpus_path, seed=0, photos=12, graphics=12, gifs=4, depth=3,
+               sizes=[(640, 480), (1920, 1080), (4000, 3000)]):
+
+    self.corpus_path = corpus_path
+
+    # Misma semilla = mismo corpus, para poder comparar resultados entre ejecuciones.
+    self.seed = seed
+
+    # Cantidad de imágenes de cada tipo
+    self.photos = photos
+    self.graphics = graphics
+    self.gifs = gifs
+
+    # Profundidad máxima de carpetas anidadas
+    self.depth = depth
+
+    # Dimensiones (ancho, alto) a usar, se reparten entre las imágenes.
+    self.sizes = sizes
+
+    # Métodos de ImageReduction a medir. Los que procesan imágenes se ejecutan
+    # sobre una copia del corpus.
+    self.entry_points = ["all_valid_files", "generated_files", "check_remaining_files",
+                         "reduce_directory", "resize_directory", "resize_limits_directory", "best_directory"]
+    self.scanners = ["all_valid_files", "generated_files", "check_remaining_files"]
+
+
+  def generate_corpus(self):
+    """Writes the synthetic site in corpus_path. Removes any previous corpus."""
+    if os.path.exists(self.corpus_path):
+      shutil.rmtree(self.corpus_path)
+
+    rng = np.random.default_rng(self.seed)
+
+    for i in range(self.photos):
+      width, height = self.sizes[i % len(self.sizes)]
+      self.photo(rng, width, height).save(self.corpus_file(rng, f"photo_{i}.jpg"), quality=95)
+
+    for i in range(self.graphics):
+      width, height = self.sizes[i % len(self.sizes)]
+      self.graphic(rng, width, height).save(self.corpus_file(rng, f"graphic_{i}.png"))
+
+    for i in range(self.gifs):
+      width, height = self.sizes[i % len(self.sizes)]
+      frames = [self.graphic(rng, width // 2, height // 2).convert("P") for _ in range(4)]
+      frames[0].save(self.corpus_file(rng, f"banner_{i}.gif"), save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+
+  def corpus_file(self, rng, file_name):
+    """Path for file_name inside a random nested folder of the corpus."""
+    folders = [f"level{level}_{rng.integers(0, 3)}" for level in range(rng.integers(0, self.depth + 1))]
+    directory = os.path.join(self.corpus_path, *folders)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, file_name)
+
+
+  def photo(self, rng, width, height):
+    """Smooth gradients plus noise, compresses like a photograph."""
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    phase = rng.random(3) * 6
+
+    channels = [np.sin(x * (4 + c) + y * (3 + c) + phase[c]) for c in range(3)]
+    pixels = (np.stack(channels, axis=-1) + 1) * 110
+    pixels += rng.normal(0, 12, (height, width, 3))
+
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+
+
+  def graphic(self, rng, width, height):
+    """Flat colored rectangles with transparency, like logos or illustrations."""
+    pixels = np.zeros((height, width, 4), dtype=np.uint8)
+    pixels[..., :3] = rng.integers(0, 256, 3)
+    pixels[..., 3] = 255
+
+    for _ in range(12):
+      x0, x1 = np.sort(rng.integers(0, width, 2))
+      y0, y1 = np.sort(rng.integers(0, height, 2))
+      pixels[y0:y1, x0:x1, :3] = rng.integers(0, 256, 3)
+
+    # Transparent corner
+    pixels[: height // 8, : width // 8, 3] = 0
+    return Image.fromarray(pixels, "RGBA")
+
+
+  def run(self, image_reduction_factory, work_path):
+    """Times every entry point. image_reduction_factory returns a new ImageReduction with the settings to benchmark.
+    Each entry point runs in its own process (to measure its peak memory) over a copy of the corpus in work_path.
+    Returns a list of results (dictionaries). Entry points that fail have an "error" instead of measurements."""
+    if not os.path.exists(self.corpus_path):
+      self.generate_corpus()
+
+    if shutil.which("gifsicle") is None:
+      print("Warning: gifsicle not found, gifs are excluded from the benchmark.")
+
+    context = multiprocessing.get_context("fork")
+    results = []
+
+    for entry_point in self.entry_points:
+      result_queue = context.Queue()
+      process = context.Process(target=self.run_entry_point, args=(image_reduction_factory, entry_point, work_path, result_queue))
+      process.start()
+      result = self.wait_result(process, result_queue, entry_point)
+      process.join()
+
+      if "error" in result:
+        print(f"Error: {entry_point} failed: {result['error']}")
+      results.append(result)
+
+    return results
+
+
+  def wait_result(self, process, result_queue, entry_point):
+    """Result put by process in result_queue. If the process ends without one (it crashed or was killed),
+    a failed result with its exit code."""
+    while True:
+      try:
+        return result_queue.get(timeout=1)
+      except queue.Empty:
+        if process.is_alive():
+          continue
+
+      # The result may arrive just after the process ends.
+      try:
+        return result_queue.get(timeout=1)
+      except queue.Empty:
+        return {"entry_point": entry_point, "error": f"process ended with exit code {process.exitcode} and no result"}
+
+
+  def run_entry_point(self, image_reduction_factory, entry_point, work_path, result_queue):
+    """Runs in a separate process. Puts the result of entry_point in result_queue."""
+    try:
+      result_queue.put(self.measure_entry_point(image_reduction_factory, entry_point, work_path))
+    except Exception as error:
+      result_queue.put({"entry_point": entry_point, "error": f"{type(error).__name__}: {error}"})
+
+
+  def measure_entry_point(self, image_reduction_factory, entry_point, work_path):
+    """Times entry_point over a copy of the corpus in work_path. Returns its result."""
+    if os.path.exists(work_path):
+      shutil.rmtree(work_path)
+    shutil.copytree(self.corpus_path, work_path)
+
+    image_reduction = image_reduction_factory()
+
+    if shutil.which("gifsicle") is None:
+      image_reduction.extensions = [ext for ext in image_reduction.extensions if ext != ".gif"]
+
+    if entry_point in self.scanners:
+      # Copies with the reduce prefix, so scanners have generated files to classify (without decoding images here).
+      for _, file_path in image_reduction.all_valid_files(work_path):
+        shutil.copyfile(file_path, image_reduction.insert_prefix(image_reduction.output_reduce_prefix, file_path))
+
+      image_reduction.clear_snapshots()
+      input_files = image_reduction.all_valid_files(work_path)
+    else:
+      input_files = image_reduction.files_above_threshold(work_path)
+
+    input_bytes = sum(os.path.getsize(file_path) for _, file_path in input_files)
+    image_reduction.clear_snapshots()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+      getattr(image_reduction, entry_point)(work_path)
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kb in linux (bytes in mac).
+    peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    return {
+      "entry_point": entry_point,
+      "images": len(input_files),
+      "seconds": round(seconds, 4),
+      "images_per_second": round(len(input_files) / seconds, 2) if seconds > 0 else 0,
+      "mb_per_second": round(input_bytes / (1024 * 1024) / seconds, 2) if seconds > 0 else 0,
+      "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+      "bytes_saved": 0 if entry_point in self.scanners else self.bytes_saved(image_reduction, work_path),
+    }
+
+
+  def bytes_saved(self, image_reduction, work_path):
+    """Sum, for each original file, of its size minus the size of its smallest generated version."""
+    image_reduction.clear_snapshots()
+    snapshot = image_reduction.get_snapshot(work_path)
+    saved = 0
+
+    for file_path, _, original_name in snapshot.files:
+      if original_name is not None:
+        continue
+
+      versions = snapshot.generated_by_original.get(os.path.basename(file_path), [])
+      versions = [version for version in versions if os.path.dirname(version[1]) == os.path.dirname(file_path)]
+
+      if len(versions) > 0:
+        smallest = min(os.path.getsize(version[1]) for version in versions)
+        saved += max(0, os.path.getsize(file_path) - smallest)
+
+    return saved
+
+
+  def print_results(self, results):
+    print(f"{'entry point':<26}{'images':>8}{'seconds':>10}{'img/s':>9}{'mb/s':>9}{'peak mb':>10}{'saved kb':>11}")
+    for result in results:
+      if "error" in result:
+        print(f"{result['entry_point']:<26}failed: {result['error']}")
+        continue
+      print(f"{result['entry_point']:<26}{result['images']:>8}{result['seconds']:>10}{result['images_per_second']:>9}"
+            f"{result['mb_per_second']:>9}{result['peak_rss_mb']:>10}{result['bytes_saved'] // 1024:>11}")
+
+
+  def save_results(self, results, results_path):
+    """Saves results as json, with the corpus settings so later runs can check they are comparable."""
+    with open(results_path, "w", encoding="utf-8") as file:
+      json.dump({"corpus": self.corpus_settings(), "results": results}, file, indent=2)
+
+
+  def compare_results(self, results, previous_results_path, tolerance=0.1):
+    """Prints the entry points that are slower (or save less) than in previous_results_path by more than tolerance."""
+    with open(previous_results_path, "r", encoding="utf-8") as file:
+      previous = json.load(file)
+
+    if previous["corpus"] != self.corpus_settings():
+      print("Warning: previous results used a different corpus, they are not comparable.")
+      return
+
+    previous_results = {result["entry_point"]: result for result in previous["results"]}
+    regressions = 0
+
+    for result in results:
+      if "error" in result:
+        print(f"Regression: {result['entry_point']} failed ({result['error']}).")
+        regressions += 1
+        continue
+
+      before = previous_results.get(result["entry_point"])
+      if before is None or "error" in before:
+        continue
+
+      if result["seconds"] > before["seconds"] * (1 + tolerance):
+        print(f"Regression: {result['entry_point']} took {result['seconds']} s (before {before['seconds']} s).")
+        regressions += 1
+
+      if result["bytes_saved"] < before["bytes_saved"] * (1 - tolerance):
+        print(f"Regression: {result['entry_point']} saved {result['bytes_saved']} bytes (before {before['bytes_saved']}).")
+        regressions += 1
+
+    if regressions == 0:
+      print(f"No regressions above {int(tolerance * 100)}%.")
+
+
+  def corpus_settings(self):
+    return {"seed": self.seed, "photos": self.photos, "graphics": self.graphics, "gifs": self.gifs,
+            "depth": self.depth, "sizes": [list(size) for size in self.sizes]}
@@ -1,49 +1,81 @@
 # @Oscar-gg
 
+# Besides os and re, it uses concurrent.futures, hashlib and json.
+
 class ViewDependencies:
 
-  def __init__ (self, directory_path, direct_dependencies, project_extensions, log_level = 2):
+  def __init__ (self, directory_path, direct_dependencies, project_extensions, log_level = 2, workers = 8, cache_path = None):
     self.directory_path = os.path.abspath(directory_path)
     self.direct_dependencies = direct_dependencies
     self.project_extensions = project_extensions
     self.log_level = log_level
 
+    # Hilos que leen y analizan archivos por adelantado. Con 1 todo se hace en orden, sin hilos.
+    self.workers = workers
+
+    # Archivo json con las referencias de cada archivo, para no volver a analizar los que no cambian.
+    self.cache_path = cache_path
+
 
   def process_direct_dependencies(self):
     self.set_initial_variables()
 
-    for dependency in self.direct_dependencies:
-      path_to_dependency = os.path.join(self.directory_path, dependency)
+    if self.workers > 1:
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
 
-      path_to_dependency = os.path.abspath(path_to_dependency)
+    try:
+      for dependency in self.direct_dependencies:
+        path_to_dependency = os.path.join(self.directory_path, dependency)
 
-      if os.path.isdir(path_to_dependency):
-        self.get_directory_dependencies(path_to_dependency)
-      elif os.path.isfile(path_to_dependency) and ViewDependencies.get_file_extension(path_to_dependency) in self.project_extensions:
-        self.process_file_dependencies(path_to_dependency)
-      else:
-        self.log_message(2, f"DIRECT dependency does not exist: {path_to_dependency}")
+        path_to_dependency = os.path.abspath(path_to_dependency)
+
+        if os.path.isdir(path_to_dependency):
+          self.get_directory_dependencies(path_to_dependency)
+        elif self.file_index.is_file(path_to_dependency) and ViewDependencies.get_file_extension(path_to_dependency) in self.project_extensions:
+          self.process_file_dependencies(path_to_dependency)
+        else:
+          self.log_message(2, f"DIRECT dependency does not exist: {path_to_dependency}")
+
+      self.save_reference_cache()
+    finally:
+      if self.executor is not None:
+        self.executor.shutdown(cancel_futures=True)
+        self.executor = None
+      self.pending_scans = {}
 
   def set_initial_variables(self):
     self.project_checked_files = set()
     self.project_file_dependencies = set()
-    extensions_available = ViewDependencies.all_file_extensions(self.directory_path)
-    self.search_pattern = ViewDependencies.get_pattern(extensions_available)
-    self.project_size = ViewDependencies.directory_size(self.directory_path)
+
+    # Archivo -> Future con sus referencias (ReferenceScanner.scan), para archivos que aún no se procesan.
+    self.executor = None
+    self.pending_scans = {}
+
+    # Un solo recorrido del directorio: las búsquedas de archivos usan el índice en vez de os.path.isfile.
+    self.file_index = FileTreeIndex(self.directory_path)
+    # Se construye al resolver la primera referencia (con el cache de referencias puede no hacer falta).
+    self.suffix_index = None
+
+    # (archivo, referencia) -> archivos posibles, cuando una referencia parcial coincide con varios.
+    self.ambiguous_references = {}
+    # Las del archivo que se está resolviendo (para el cache de referencias).
+    self.file_ambiguities = []
+
+    extensions_available = ViewDependencies.all_file_extensions(self.directory_path, self.file_index)
+    self.reference_scanner = ReferenceScanner(extensions_available)
+    self.load_reference_cache()
+    self.project_size = ViewDependencies.directory_size(self.directory_path, self.file_index)
 
   def show_unused_files(self, threshold_kb=0, exclude_extensions=[]):
     unused_files = []
-    for root, _, files in os.walk(self.directory_path):
-      for file in files:
-        file_path = os.path.join(root, file)
-
-        if file_path not in self.project_file_dependencies:
-          unused_files.append(file_path)
+    for file_path in self.file_index.files_in(self.directory_path):
+      if file_path not in self.project_file_dependencies:
+        unused_files.append(file_path)
 
     sort_files = []
     total_size = 0
     for file in unused_files:
-      size_kb = ViewDependencies.file_size_kb(file)
+      size_kb = self.file_index.sizes[file]
       total_size += size_kb
       sort_files.append((size_kb, file))
 
@@ -69,19 +101,16 @@ class ViewDependencies:
   def show_unused_directories(self):
     print("Unused directories:")
     directories = []
-    for root, dirs, _ in os.walk(self.directory_path):
-      for directory in dirs:
-        directory_path = os.path.join(root, directory)
-
-        if self.dir_is_unused(directory_path):
-          directories.append(directory_path)
+    for directory_path in self.file_index.directories:
+      if self.dir_is_unused(directory_path):
+        directories.append(directory_path)
 
     directories = ViewDependencies.remove_contained_directories(directories)
 
     # Sort directories by size and display.
     sorted_dirs = []
     for directory in directories:
-      sorted_dirs.append((ViewDependencies.directory_size(directory), directory))
+      sorted_dirs.append((ViewDependencies.directory_size(directory, self.file_index), directory))
 
     sorted_dirs.sort(reverse=True)
 
@@ -127,42 +156,244 @@ class ViewDependencies:
         print(file)
 
   def get_directory_dependencies(self, path_to_directory):
-    for root, _, files in os.walk(path_to_directory):
-      for file in files:
-        file_path = os.path.join(root, file)
-        if os.path.isfile(file_path):
-          self.project_file_dependencies.add(file_path)
-          if ViewDependencies.get_file_extension(file_path) in self.project_extensions:
-            self.process_file_dependencies(file_path)
-        else:
-          self.log_message(2, f"directory dependency does not exist: {file_path}")
+    file_paths = self.file_index.files_in(path_to_directory)
+    self.prefetch_references(file_paths)
+
+    for file_path in file_paths:
+      self.project_file_dependencies.add(file_path)
+      if ViewDependencies.get_file_extension(file_path) in self.project_extensions:
+        self.process_file_dependencies(file_path)
 
 
   def process_file_dependencies(self, path_to_file):
+    """Adds path_to_file and the files it references, depth first. Uses a stack instead of recursion, so long chains
+    of references don't reach the recursion limit. Files are read and scanned ahead by self.executor, but only this
+    thread resolves references and changes the sets, in the same order as without threads (same results and messages)."""
     if path_to_file in self.project_checked_files:
       return
 
+    # (archivo, iterador de sus dependencias pendientes)
+    stack = [self.start_file_dependencies(path_to_file)]
+
+    while len(stack) > 0:
+      parent_path, file_dependencies = stack[-1]
+      file_path = next(file_dependencies, None)
+
+      if file_path is None:
+        stack.pop()
+        continue
+
+      if self.file_index.is_file(file_path):
+          self.project_file_dependencies.add(file_path)
+          if ViewDependencies.get_file_extension(file_path) in self.project_extensions and file_path not in self.project_checked_files:
+            stack.append(self.start_file_dependencies(file_path))
+      else:
+        self.log_message(2, f"file dependency does not exist: {file_path}.\nFile was referenced in {parent_path}")
+
+
+  def start_file_dependencies(self, path_to_file):
+    """Marks path_to_file as checked and resolves its dependencies. Returns (path_to_file, iterator of dependencies)."""
     self.project_checked_files.add(path_to_file)
     self.project_file_dependencies.add(path_to_file)
 
+    entry = self.file_entry(path_to_file)
+    if "dependencies" in entry and self.same_outside_files(entry):
+      file_dependencies_list = self.cached_file_dependencies(path_to_file, entry)
+    else:
+      file_dependencies_list = self.resolve_file_dependencies(path_to_file, entry)
+
+    if self.reference_cache is not None:
+      relative_path = self.relative_path(path_to_file)
+      if self.reference_cache["files"].get(relative_path) is not entry:
+        self.reference_cache["files"][relative_path] = entry
+        self.reference_cache_changed = True
+
+    self.pending_scans.pop(path_to_file, None)
+    self.prefetch_references(file_dependencies_list)
+
+    return path_to_file, iter(file_dependencies_list)
+
+
+  def resolve_file_dependencies(self, path_to_file, entry):
+    """general_file_dependencies, saving the result in entry for the reference cache, with the files outside
+    directory_path that were checked (the tree fingerprint doesn't cover them)."""
+    outside_checks = len(self.file_index.outside_checks)
+    self.file_ambiguities = []
+
     file_dependencies_list = self.general_file_dependencies(path_to_file)
 
-    for file_path in file_dependencies_list:
-      if os.path.isfile(file_path):
-          self.project_file_dependencies.add(file_path)
-          if ViewDependencies.get_file_extension(file_path) in self.project_extensions:
-            self.process_file_dependencies(file_path)
-      else:
-        self.log_message(2, f"file dependency does not exist: {file_path}.\nFile was referenced in {path_to_file}")
+    if self.reference_cache is not None:
+      entry["dependencies"] = [self.relative_path(file_path) for file_path in file_dependencies_list]
+      entry["ambiguous"] = [[reference, [self.relative_path(candidate) for candidate in candidates]]
+                            for reference, candidates in self.file_ambiguities]
+      entry["outside"] = {self.relative_path(file_path): exists
+                          for file_path, exists in self.file_index.outside_checks[outside_checks:]}
+      self.reference_cache_changed = True
+
+    return file_dependencies_list
+
+
+  def same_outside_files(self, entry):
+    """Whether the files outside directory_path checked by resolve_file_dependencies still exist (or not)."""
+    return all(os.path.isfile(self.absolute_path(file_path)) == exists for file_path, exists in entry["outside"].items())
+
+
+  def cached_file_dependencies(self, path_to_file, entry):
+    """Dependencies saved by resolve_file_dependencies. Reports its ambiguous references again."""
+    for reference, candidates in entry["ambiguous"]:
+      self.report_ambiguous_reference(path_to_file, reference, [self.absolute_path(candidate) for candidate in candidates])
+
+    return [self.absolute_path(file_path) for file_path in entry["dependencies"]]
+
+
+  def prefetch_references(self, file_paths):
+    """Starts reading and scanning the files in file_paths that will be processed later, if there's an executor."""
+    if self.executor is None:
+      return
+
+    for file_path in file_paths:
+      if file_path in self.project_checked_files or file_path in self.pending_scans:
+        continue
+
+      if ViewDependencies.get_file_extension(file_path) in self.project_extensions and self.file_index.is_file(file_path):
+        self.pending_scans[file_path] = self.executor.submit(self.scan_file, file_path)
+
+
+  def file_references(self, path_to_file):
+    """(quoted_paths, import_specifiers) of path_to_file."""
+    quoted_paths, import_specifiers = self.file_entry(path_to_file)["references"]
+    return quoted_paths, import_specifiers
+
+
+  def file_entry(self, path_to_file):
+    """Cache entry of path_to_file (see scan_file). Uses the scan started by prefetch_references, if any."""
+    pending_scan = self.pending_scans.get(path_to_file)
+
+    if pending_scan is None:
+      pending_scan = concurrent.futures.Future()
+      pending_scan.set_result(self.scan_file(path_to_file))
+      self.pending_scans[path_to_file] = pending_scan
+
+    return pending_scan.result()
+
+
+  def scan_file(self, path_to_file):
+    """Reads and scans path_to_file, unless the reference cache has it with the same size and modification time
+    (or the same contents). Returns its cache entry. Runs in the executor's threads: it must not change the analysis state."""
+    imports = ViewDependencies.get_file_extension(path_to_file) == ".js"
+
+    if self.reference_cache is None:
+      return {"references": self.reference_scanner.scan(ViewDependencies.read_file(path_to_file), imports=imports)}
+
+    cached = self.reference_cache["files"].get(self.relative_path(path_to_file))
+    if path_to_file in self.file_index.sizes:
+      size_kb = self.file_index.sizes[path_to_file]
+      modified = self.file_index.modified[path_to_file]
+    else:
+      # Outside directory_path, not indexed
+      stat = os.stat(path_to_file)
+      size_kb = stat.st_size / 1024
+      modified = stat.st_mtime_ns
+
+    if cached is not None and cached["size_kb"] == size_kb and cached["modified"] == modified:
+      return cached
+
+    # A new checkout changes the modification time but not the contents.
+    file_as_string = ViewDependencies.read_file(path_to_file)
+    content_hash = hashlib.sha256(file_as_string.encode("utf-8")).hexdigest()
+
+    if cached is not None and cached["hash"] == content_hash:
+      return dict(cached, size_kb=size_kb, modified=modified)
+
+    references = self.reference_scanner.scan(file_as_string, imports=imports)
+    return {"size_kb": size_kb, "modified": modified, "hash": content_hash, "references": references}
+
+
+  def relative_path(self, file_path):
+    # Faster than os.path.relpath for the paths inside directory_path, which are most of them.
+    if file_path.startswith(self.directory_path + os.sep):
+      return file_path[len(self.directory_path) + 1:]
+    return os.path.relpath(file_path, self.directory_path)
+
+
+  def absolute_path(self, relative_path):
+    return os.path.normpath(os.path.join(self.directory_path, relative_path))
+
+
+  def reference_cache_key(self):
+    """What the cached references depend on besides each file: the scanner and the extensions in the project
+    (adding or removing the only file with some extension changes which quoted paths are references)."""
+    return {"scanner_version": ReferenceScanner.version, "extensions": sorted(self.reference_scanner.extensions)}
+
+
+  def tree_fingerprint(self):
+    """Hash of the paths of every file in the project. The files that references resolve to depend on it."""
+    relative_paths = sorted(self.relative_path(file_path) for file_path in self.file_index.sizes)
+    return hashlib.sha256("\n".join(relative_paths).encode("utf-8")).hexdigest()
+
+
+  def load_reference_cache(self):
+    self.reference_cache = None
+    self.reference_cache_changed = True
+
+    if self.cache_path is None:
+      return
+
+    self.reference_cache = {"key": self.reference_cache_key(), "tree": self.tree_fingerprint(), "files": {}}
+
+    if not os.path.exists(self.cache_path):
+      return
+
+    try:
+      with open(self.cache_path, "r", encoding="utf-8") as file:
+        cache = json.load(file)
+    except (OSError, ValueError):
+      self.log_message(2, f"reference cache can't be read, starting a new one: {self.cache_path}")
+      return
+
+    if cache.get("key") != self.reference_cache["key"]:
+      self.log_message(3, "reference cache is from another scanner version or set of extensions, starting a new one.")
+      return
+
+    self.reference_cache["files"] = cache["files"]
+    self.reference_cache_changed = False
+
+    # References are still valid if files were added or removed, but not the files they resolve to.
+    if cache.get("tree") != self.reference_cache["tree"]:
+      self.reference_cache_changed = True
+      for entry in self.reference_cache["files"].values():
+        entry.pop("dependencies", None)
+        entry.pop("ambiguous", None)
+        entry.pop("outside", None)
+
+
+  def save_reference_cache(self):
+    if self.reference_cache is None:
+      return
+
+    # Entries of files that were removed
+    files = self.reference_cache["files"]
+    self.reference_cache["files"] = {path: entry for path, entry in files.items()
+                                     if self.file_index.is_file(self.absolute_path(path))}
+
+    if not self.reference_cache_changed and len(self.reference_cache["files"]) == len(files):
+      return
+
+    # Write to a temporary file first, so an interrupted run doesn't corrupt the cache.
+    temp_path = self.cache_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+      json.dump(self.reference_cache, file)
+
+    os.replace(temp_path, self.cache_path)
 
 
   def general_file_dependencies(self, path_to_file):
     ext = ViewDependencies.get_file_extension(path_to_file)
     file_dependencies = []
     if ext in [".js"]:
-      file_dependencies = self.get_javascript_file_dependencies(path_to_file, self.search_pattern)
+      file_dependencies = self.get_javascript_file_dependencies(path_to_file)
     elif ext in self.project_extensions:
-      file_dependencies = self.get_file_dependencies(path_to_file, self.search_pattern)
+      file_dependencies = self.get_file_dependencies(path_to_file)
     else:
       self.log_message(2, f"Extension {ext} is not included: {path_to_file}")
 
@@ -172,16 +403,11 @@ class ViewDependencies:
     return file_dependencies
 
 
-  def get_file_dependencies(self, path_to_file, search_pattern):
+  def get_file_dependencies(self, path_to_file):
     file_list = []
-    file_as_string = ViewDependencies.read_file_as_string(path_to_file)
-
-    matches = re.findall(search_pattern, file_as_string)
-    dirname = os.path.dirname(path_to_file)
-
-    for match in matches:
-      dependency = match[1]
+    quoted_paths, _ = self.file_references(path_to_file)
 
+    for dependency in quoted_paths:
       discard, dependency_path = self.possible_paths(path_to_file, dependency)
       if discard:
         continue
@@ -191,18 +417,14 @@ class ViewDependencies:
     return file_list
 
 
-  def get_javascript_file_dependencies(self, path_to_file, general_search_pattern):
+  def get_javascript_file_dependencies(self, path_to_file):
     file_list = []
 
-    # Para imports especificos de javascript
-    js_pattern = r"""import(\s*([^;<>]+)\s*from\s*|\s+)(["'])([^"\';]+)(\3);?"""
-
-    file_as_string = ViewDependencies.read_file_as_string(path_to_file)
-    matches_javascript = re.findall(js_pattern, file_as_string)
+    # Imports especificos de javascript y paths genéricos, de una sola lectura del archivo
+    quoted_paths, import_specifiers = self.file_references(path_to_file)
     dirname = os.path.dirname(path_to_file)
 
-    for match in matches_javascript:
-      file_name = match[3]
+    for file_name in import_specifiers:
       # Ignorar file si no tiene directorio, añadir file si tiene algún directorio.
       if not os.path.dirname(file_name) == "":
         file_name += ".js"
@@ -212,11 +434,7 @@ class ViewDependencies:
     # Procesar otros tipos de paths usando patrón genérico
     # Si el path tiene algun directorio en común con el archivo, asumir que está
     # en ese directorio.
-    matches = re.findall(general_search_pattern, file_as_string)
-
-    for match in matches:
-      dependency = match[1]
-
+    for dependency in quoted_paths:
       # Saltar archivos sin folder en arhivos .js
       if os.path.dirname(dependency) == "":
         continue
@@ -236,17 +454,23 @@ class ViewDependencies:
 
     dependency_path = os.path.join(dirname, dependency_path_in_file)
     dependency_path = os.path.normpath(dependency_path)
-    if os.path.isfile(dependency_path):
+    if self.file_index.is_file(dependency_path):
       return [False, dependency_path]
 
     dependency_path = self.merge_paths(path_to_file, dependency_path_in_file)
     discard = False
 
     # If merged path wasn't found, try attaching the path to the original directory.
-    if not os.path.isfile(dependency_path):
+    if not self.file_index.is_file(dependency_path):
       discard, dependency_path = self.discard_path(dirname, dependency_path_in_file)
 
-    if os.path.isfile(dependency_path):
+    # Last, a file anywhere in directory_path whose path ends with the reference (partial paths like img/logo.png).
+    if not discard and not self.file_index.is_file(dependency_path):
+      closest_path = self.closest_suffix_match(path_to_file, dependency_path_in_file)
+      if closest_path is not None:
+        dependency_path = closest_path
+
+    if self.file_index.is_file(dependency_path):
       self.log_message(3, f"Found dependency: {dependency_path}.")
     return [discard, dependency_path]
 
@@ -259,7 +483,7 @@ class ViewDependencies:
     actual_path = os.path.normpath(os.path.join(dirname, file_name))
 
     # If path can't be found, try to find it in the directory_path
-    if not os.path.isfile(actual_path):
+    if not self.file_index.is_file(actual_path):
       actual_path = os.path.join(self.directory_path, file_name)
       actual_path = os.path.normpath(actual_path)
       actual_path = os.path.abspath(actual_path)
@@ -268,31 +492,72 @@ class ViewDependencies:
 
 
   def merge_paths(self, parent_path, child_path):
-    """Returns location of child_path inside parent_path, assuming child_path is contained within parent_path."""
-    parent_folders = ViewDependencies.folders_in_path(parent_path)
-    dir_child = os.path.dirname(child_path)
-    base_name = os.path.basename(child_path)
+    """Returns location of child_path inside parent_path, assuming child_path is contained within parent_path:
+    the file whose path ends with child_path that is in the shallowest folder of parent_path."""
+    parent_directory = os.path.dirname(parent_path)
+    in_parent_folders = []
+
+    for candidate in self.get_suffix_index().lookup(child_path):
+      candidate_directory = os.path.dirname(candidate)
+      if parent_directory == candidate_directory or parent_directory.startswith(candidate_directory + os.sep):
+        in_parent_folders.append(candidate)
 
-    for folder in parent_folders:
-      if folder.endswith(dir_child):
-        return os.path.join(folder, base_name)
+    if len(in_parent_folders) > 0:
+      return min(in_parent_folders, key=len)
 
     self.log_message(3, f"failed to find {child_path} within {parent_path}.")
 
     return "Failed"
 
 
-  def folders_in_path(path):
-    folders = []
-    past = os.path.dirname(path)
+  def closest_suffix_match(self, path_to_file, reference):
+    """File anywhere in directory_path whose path ends with reference (which must include a folder), or None.
+    If there are several, the one that shares more folders with path_to_file. If that doesn't decide it,
+    the reference isn't resolved and it is reported (see show_ambiguous_references)."""
+    # A name alone (logo.png) could be any file with that name.
+    if len(PathSuffixIndex.components(reference)) < 2:
+      return None
+
+    candidates = self.get_suffix_index().lookup(reference)
+
+    if len(candidates) == 0:
+      return None
+
+    if len(candidates) > 1:
+      directory = os.path.dirname(path_to_file)
+      shared = {candidate: len(os.path.commonpath([directory, candidate])) for candidate in candidates}
+      most_shared = max(shared.values())
+      candidates = [candidate for candidate in candidates if shared[candidate] == most_shared]
+
+    if len(candidates) > 1:
+      self.report_ambiguous_reference(path_to_file, reference, candidates)
+      return None
+
+    return candidates[0]
+
+
+  def report_ambiguous_reference(self, path_to_file, reference, candidates):
+    self.ambiguous_references[(path_to_file, reference)] = candidates
+    self.file_ambiguities.append([reference, candidates])
+    self.log_message(2, f"ambiguous reference {reference} in {path_to_file}, it matches {len(candidates)} files. It is not resolved.")
 
-    while len(path) > 1 and path != past:
-      folders.append(os.path.dirname(path))
-      past = path
-      path = os.path.dirname(path)
 
-    list.reverse(folders)
-    return folders
+  def get_suffix_index(self):
+    if self.suffix_index is None:
+      self.suffix_index = PathSuffixIndex(self.file_index.sizes)
+    return self.suffix_index
+
+
+  def show_ambiguous_references(self):
+    if len(self.ambiguous_references) == 0:
+      print("No ambiguous references.")
+      return
+
+    print(f"{len(self.ambiguous_references)} references match several files:")
+    for (path_to_file, reference), candidates in self.ambiguous_references.items():
+      print(f"{reference} (in {path_to_file}):")
+      for candidate in candidates:
+        print(f"  {candidate}")
 
 
   def remove_contained_directories(directory_list):
@@ -310,7 +575,11 @@ class ViewDependencies:
     return directories
 
 
-  def directory_size(directory_path):
+  def directory_size(directory_path, file_index=None):
+    """Size (kb) of the files in directory_path. With file_index (a FileTreeIndex that contains it), it doesn't walk the directory."""
+    if file_index is not None:
+      return file_index.directory_size(directory_path)
+
     total_size = 0
     for root, _, files in os.walk(directory_path):
       for file in files:
@@ -325,32 +594,26 @@ class ViewDependencies:
 
 
   def dir_is_unused(self, directory):
-    for root, _, files in os.walk(directory):
-      for file in files:
-        file_path = os.path.join(root, file)
-        if file_path in self.project_file_dependencies:
-            return False
+    for file_path in self.file_index.files_in(directory):
+      if file_path in self.project_file_dependencies:
+        return False
 
     return True
 
 
   def dir_used_files(self, directory):
     used_dir_files = []
-    for root, _, files in os.walk(directory):
-      for file in files:
-        file_path = os.path.join(root, file)
-        if file_path in self.project_file_dependencies:
-            used_dir_files.append(file_path)
+    for file_path in self.file_index.files_in(directory):
+      if file_path in self.project_file_dependencies:
+        used_dir_files.append(file_path)
 
     return used_dir_files
 
   def dir_unused_files(self, directory):
     unused_dir_files = []
-    for root, _, files in os.walk(directory):
-      for file in files:
-        file_path = os.path.join(root, file)
-        if file_path not in self.project_file_dependencies:
-            unused_dir_files.append(file_path)
+    for file_path in self.file_index.files_in(directory):
+      if file_path not in self.project_file_dependencies:
+        unused_dir_files.append(file_path)
 
     return unused_dir_files
 
@@ -360,7 +623,11 @@ class ViewDependencies:
     return ext
 
 
-  def all_file_extensions(directory_path):
+  def all_file_extensions(directory_path, file_index=None):
+    """Extensions of the files in directory_path. With file_index (a FileTreeIndex of directory_path), it doesn't walk the directory."""
+    if file_index is not None:
+      return list(set(ViewDependencies.get_file_extension(file_path) for file_path in file_index.sizes))
+
     file_types = set()
     for root, _, files in os.walk(directory_path):
       for file in files:
@@ -370,32 +637,9 @@ class ViewDependencies:
     return list(file_types)
 
 
-  def get_pattern(ext):
-    pattern_end = '('
-
-    for i in range(len(ext)):
-      if ext[i] == "":
-        continue
-
-      pattern_end += ext[i][1:] # Quitar . de la extension
-
-      if i != len(ext) - 1:
-        pattern_end += "|"
-
-    pattern_end += ')'
-    pattern = r"""(['"])(([^'<>"]*)\.""" + pattern_end + r"\s*)(\1)"
-    return pattern
-
-
-  def read_file_as_string(file_path, encoding_='utf-8'):
+  def read_file(file_path, encoding_='utf-8'):
     with open(file_path, 'r', encoding=encoding_) as file:
-      file_contents = file.read()
-      return ViewDependencies.clean_string(file_contents)
-
-
-  # Remove line breaks
-  def clean_string(file_as_string):
-    return file_as_string.replace('\n', '')
+      return file.read()
 
 
   def log_message(self, log_level, message):
@@ -425,4 +669,192 @@ class ViewDependencies:
       new_size = new_size / 1024
       counter += 1
 
-    return f"{new_size:.2f} {sizes[counter]}"
\ No newline at end of file
+    return f"{new_size:.2f} {sizes[counter]}"
+
+
+class FileTreeIndex:
+  """Every file under directory_path, with its size, from a single scan (same order as os.walk).
+  Checking whether a file exists is a set lookup instead of a syscall, which matters on network mounts (Drive)."""
+
+  def __init__(self, directory_path):
+    self.directory_path = os.path.normpath(directory_path)
+
+    # file_path -> size in kb, in the order of os.walk.
+    self.sizes = {}
+
+    # file_path -> modification time (st_mtime_ns)
+    self.modified = {}
+
+    # (path, exists) of each absolute path outside directory_path that is_file checked in the file system.
+    self.outside_checks = []
+
+    # Subdirectories, in the order of os.walk (including links to directories, which aren't scanned).
+    self.directories = []
+
+    # directory -> total size in kb of the files inside it (at any depth).
+    self.directory_sizes = {}
+
+    self.scan()
+
+
+  def scan(self):
+    # Depth first, files of a directory before its subdirectories, like os.walk.
+    pending = [self.directory_path]
+
+    while len(pending) > 0:
+      directory = pending.pop()
+      subdirectories = []
+
+      try:
+        entries = list(os.scandir(directory))
+      except OSError:
+        continue
+
+      for entry in entries:
+        if entry.is_dir():
+          self.directories.append(entry.path)
+          if not entry.is_symlink():
+            subdirectories.append(entry.path)
+        elif entry.is_file():
+          stat = entry.stat()
+          self.add_file(entry.path, stat.st_size / 1024)
+          self.modified[entry.path] = stat.st_mtime_ns
+
+      pending.extend(reversed(subdirectories))
+
+
+  def add_file(self, file_path, size_kb):
+    self.sizes[file_path] = size_kb
+
+    directory = os.path.dirname(file_path)
+    while True:
+      self.directory_sizes[directory] = self.directory_sizes.get(directory, 0) + size_kb
+
+      if directory == self.directory_path or len(directory) <= len(self.directory_path):
+        break
+      directory = os.path.dirname(directory)
+
+
+  def contains(self, path):
+    return path == self.directory_path or path.startswith(self.directory_path + os.sep)
+
+
+  def is_file(self, file_path):
+    """Same as os.path.isfile. Paths outside directory_path aren't indexed, so those still check the file system."""
+    file_path = os.path.normpath(file_path)
+
+    if not self.contains(file_path):
+      exists = os.path.isfile(file_path)
+      if os.path.isabs(file_path):
+        self.outside_checks.append((file_path, exists))
+      return exists
+
+    return file_path in self.sizes
+
+
+  def files_in(self, directory):
+    """Files inside directory (at any depth), in the order of os.walk."""
+    directory = os.path.normpath(directory)
+
+    if directory == self.directory_path:
+      return list(self.sizes)
+
+    if not self.contains(directory):
+      return [os.path.join(root, file) for root, _, files in os.walk(directory) for file in files]
+
+    return [file_path for file_path in self.sizes if file_path.startswith(directory + os.sep)]
+
+
+  def directory_size(self, directory):
+    return self.directory_sizes.get(os.path.normpath(directory), 0)
+
+
+class PathSuffixIndex:
+  """Trie of the files of a FileTreeIndex keyed on their path components in reverse (name, folder, parent folder...).
+  lookup() finds every file whose path ends with a reference in time proportional to the reference length,
+  instead of comparing it with every folder."""
+
+  def __init__(self, file_paths):
+    # Each node is [children, files]: files are the paths that end with the components leading to the node.
+    self.root = [{}, []]
+
+    for file_path in file_paths:
+      self.add(file_path)
+
+
+  def add(self, file_path):
+    node = self.root
+    for component in reversed(file_path.split(os.sep)):
+      if component == "":
+        continue
+
+      node = node[0].setdefault(component, [{}, []])
+      node[1].append(file_path)
+
+
+  def lookup(self, reference):
+    """Files (in the order they were added) whose path ends with the components of reference."""
+    components = PathSuffixIndex.components(reference)
+    if len(components) == 0:
+      return []
+
+    node = self.root
+    for component in reversed(components):
+      node = node[0].get(component)
+      if node is None:
+        return []
+
+    return node[1]
+
+
+  def components(reference):
+    """Folders and name of reference. Leading /, ./ and ../ are ignored, and urls have none."""
+    reference = reference.strip().replace("\\", "/")
+
+    if "://" in reference or reference.startswith("//"):
+      return []
+
+    return [component for component in os.path.normpath("/" + reference).split("/") if component != ""]
+
+
+class ReferenceScanner:
+  """Finds the references of a file: quoted paths that end with one of the project's extensions and, for javascript,
+  import specifiers. Both are found in the file as is (line breaks are removed only from the texts found), the patterns
+  are compiled once and extensions are checked in a set. Unlike the old search on the text without line breaks, an
+  import whose path is on the next line (import\n"./a.js") is found."""
+
+  # Cambiar si cambia lo que se considera una referencia (invalida resultados guardados).
+  version = 3
+
+  # Any quoted text whose name has an extension. Texts with an extension that isn't in the project are
+  # discarded afterwards, and the search continues from their opening quote.
+  path_pattern = re.compile(r"""(['"])([^'<>"]*\.[^'<>"./]*)\1""")
+  import_pattern = re.compile(r"""import(\s*([^;<>]+)\s*from\s*|\s+)(["'])([^"\';]+)(\3);?""")
+
+  def __init__(self, extensions):
+    self.extensions = set(ext[1:] for ext in extensions if ext != "")
+
+
+  def scan(self, file_as_string, imports=False):
+    """Returns (quoted_paths, import_specifiers), in the order they appear."""
+    quoted_paths = []
+    position = 0
+
+    while True:
+      match = self.path_pattern.search(file_as_string, position)
+      if match is None:
+        break
+
+      path = match.group(2).replace("\n", "")
+      if path.rstrip().rpartition(".")[2] in self.extensions:
+        quoted_paths.append(path)
+        position = match.end()
+      else:
+        position = match.start() + 1
+
+    import_specifiers = []
+    if imports:
+      for match in self.import_pattern.finditer(file_as_string):
+        import_specifiers.append(match.group(4).replace("\n", ""))
+
+    return quoted_paths, import_specifiers
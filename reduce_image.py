@@ -10,7 +10,13 @@ class ImageReduction:
                extensions=[".png", ".jpg",".jpeg", ".gif"],
                max_img_width_px=1000, max_img_height_px=1000, resize=False, reduce_all_valid_files=False,
                output_reduce_prefix="IR_", output_resize_prefix = "R_", best_prefix="B_", max_resize=0.6,
-               colors_=32, scale_ratio='0.5', lossiness_factor='80'):
+               colors_=32, scale_ratio='0.5', lossiness_factor='80', workers=1,
+               manifest_path=None, gif_workers=4, max_image_mb=None, metrics_sink=None,
+               adaptive_png=False, min_colors_png=16, png_quantizer=None, min_ssim=None,
+               modern_formats=[], webp_quality=80, avif_quality=60,
+               srcset_widths=[320, 640, 1024, 1600], srcset_prefix="S_",
+               deduplicate=False, duplicate_distance=4, shard_results_dir=None, classify=False,
+               lossless_seconds=None, lossless_run_seconds=None):
 
     self.threshold_kb = threshold_kb # Reducir solo imágenes que tengan peso mayor
 
@@ -19,6 +25,41 @@ class ImageReduction:
 
     self.colors_png = colors_png # Cantidad de colores a usar en png, potencia de 2.
 
+    # Si es verdadero, en png se busca la mayor cantidad de colores (de 256 a
+    # min_colors_png) con la que la imagen queda debajo del threshold, en vez de usar colors_png.
+    self.adaptive_png = adaptive_png
+    self.min_colors_png = min_colors_png
+
+    # Método para reducir colores en png: None (default de Pillow), "fast" (fast octree),
+    # "quality" (libimagequant si está disponible, si no median cut) o uno específico:
+    # "mediancut", "maxcoverage", "fastoctree", "libimagequant".
+    self.png_quantizer = png_quantizer
+    self.quantizer = self.resolve_quantizer(png_quantizer)
+
+    # Similitud mínima (SSIM, de 0 a 1) entre la imagen original y la reducida. Si se
+    # especifica, en jpg y png se usa la menor calidad / cantidad de colores que la cumpla,
+    # en vez de min_quality, colors_png y el threshold. Con None no se usa.
+    self.min_ssim = min_ssim
+
+    # Si es verdadero, antes de codificar se clasifica la imagen (foto o gráfico) con una miniatura, y se
+    # usa la estrategia adecuada: png de fotos sin reducir colores (si así queda debajo del threshold), jpg de
+    # gráficos sin buscar calidad, webp sin pérdida para gráficos. min_ssim tiene prioridad.
+    self.classify = classify
+
+    # Segundos (máximo) a usar por archivo en una etapa extra sin pérdida: jpg progresivo y otras
+    # estrategias de compresión para png. Se queda la versión más chica. Con None no se usa.
+    # lossless_run_seconds limita el total de la ejecución (los archivos más grandes se procesan primero).
+    self.lossless_seconds = lossless_seconds
+    self.lossless_run_seconds = lossless_run_seconds
+    self.lossless_deadline = None
+
+    # Formatos adicionales (".webp", ".avif") a generar junto a cada png / jpg reducido o
+    # redimensionado, a partir de la misma imagen decodificada. Se guardan con el mismo
+    # nombre más la extensión: IR_foto.jpg -> IR_foto.jpg.webp
+    self.modern_formats = self.supported_formats(modern_formats)
+    self.webp_quality = webp_quality
+    self.avif_quality = avif_quality
+
     # Solo hay implementación para .png y .jpg. Si se agregan más solo apareceran
     # en print_files_above_threshold(). Quitar .png o .jpg para ignorar archivos
     self.extensions = extensions
@@ -39,255 +80,1869 @@ class ImageReduction:
     self.output_resize_prefix = output_resize_prefix
     self.best_prefix = best_prefix
 
-    # Evitar sobreescribir imágenes originales
-    if len(self.output_reduce_prefix) == 0:
-      self.output_reduce_prefix = "IR_"
+    # Evitar sobreescribir imágenes originales
+    if len(self.output_reduce_prefix) == 0:
+      self.output_reduce_prefix = "IR_"
+
+    if len(self.output_resize_prefix) == 0:
+      self.output_resize_prefix = "R_"
+
+    if len(self.best_prefix) == 0:
+      self.best_prefix = "B_"
+
+    # Solo se usa con resize_directory
+    self.max_resize = max_resize
+
+    # Si es verdadero, las copias de una misma imagen (mismo contenido, o la misma imagen guardada de
+    # nuevo) se procesan una sola vez, y el resultado se copia para las demás. duplicate_distance es
+    # la cantidad de bits diferentes permitida en el hash perceptual (dHash de 64 bits), 0 = solo copias exactas.
+    self.deduplicate = deduplicate
+    self.duplicate_distance = duplicate_distance
+
+    # Carpeta donde cada máquina guarda el resultado de su parte (shard) de un directorio, para
+    # unirlos después con merge_shard_results. Con None se usa una carpeta junto al directorio procesado
+    # (directorio + "_shard_results"), para no agregar archivos al sitio.
+    self.shard_results_dir = shard_results_dir
+
+    # Anchos (px) a generar con srcset_directory, para imágenes responsivas. Cada uno se guarda
+    # como srcset_prefix + ancho + "_" + nombre: S_640_foto.jpg
+    self.srcset_widths = srcset_widths
+    self.srcset_prefix = srcset_prefix
+
+    if len(self.srcset_prefix) == 0:
+      self.srcset_prefix = "S_"
+
+    # Opciones para gifs
+    self.colors_= colors_
+    self.scale_ratio = scale_ratio
+    self.lossiness_factor = lossiness_factor
+
+    # Cantidad de procesos para reducir imágenes en paralelo. Con 1 se procesa
+    # un archivo a la vez.
+    self.workers = workers
+
+    # Archivo json donde se guardan los archivos ya procesados (hash del contenido
+    # y opciones usadas), para no volver a procesarlos en otras ejecuciones.
+    # Con None no se usa.
+    self.manifest_path = manifest_path
+    self.manifest = None
+
+    # DirectorySnapshot de cada directorio consultado. Se borran cuando se
+    # generan, mueven o eliminan archivos.
+    self.snapshots = {}
+
+    # Máximo de procesos de gifsicle ejecutándose al mismo tiempo.
+    self.gif_workers = gif_workers
+
+    # Resultado de cada ejecución de gifsicle: (archivo, segundos, código de salida, salida).
+    self.gif_log = []
+
+    # Memoria máxima (mb) que puede usar una imagen decodificada. Las imágenes
+    # que la sobrepasan no se procesan. Con None no hay límite.
+    self.max_image_mb = max_image_mb
+
+    # Dónde guardar las métricas de cada archivo: una lista, la ruta de un archivo
+    # json lines, o una función que recibe cada registro. Con None no se guardan.
+    self.metrics_sink = metrics_sink
+
+    # Registros de la última ejecución, y su resumen (ver metrics_summary).
+    self.run_records = []
+    self.run_summary = None
+
+    # Registro del archivo que se está procesando en cada thread.
+    self.current_records = {}
+
+
+  def __getstate__(self):
+    # The manifest, snapshots, gif log and metrics aren't needed by the worker processes.
+    state = self.__dict__.copy()
+    state["manifest"] = None
+    state["snapshots"] = {}
+    state["gif_log"] = []
+    state["metrics_sink"] = None
+    state["run_records"] = []
+    state["current_records"] = {}
+    return state
+
+
+  def reduce_directory(self, path_to_directory, only_extensions=[], shard=None):
+    """Reduces the valid files above threshold (or all of them, with reduce_all_valid_files).
+    shard is (index, count): only the files of that part of the directory are processed (see shard_files)."""
+
+    temp_extensions = self.extensions
+
+    # Temporarily limit the extensions to consider
+    if len(only_extensions) > 0:
+      self.extensions = only_extensions
+
+    files_to_reduce = []
+
+    if self.reduce_all_valid_files:
+      files_to_reduce = self.all_valid_files(path_to_directory)
+    else:
+      files_to_reduce = self.files_above_threshold(path_to_directory)
+
+    files_to_reduce = self.shard_files(files_to_reduce, path_to_directory, shard)
+    self.process_files(self.reduce_file, files_to_reduce, "reduce")
+    self.save_shard_results(path_to_directory, shard, "reduce")
+
+    # Restore the extensions to consider
+    if len(only_extensions) > 0:
+      self.extensions = temp_extensions
+
+
+  def resize_limits_directory(self, path_to_directory, all=False):
+    """Only resizes valid images to max width or max height specified."""
+    files_to_resize=[]
+    if all:
+      files_to_resize = self.all_valid_files(path_to_directory)
+    else:
+      files_to_resize = self.files_above_threshold(path_to_directory)
+
+    self.process_files(self.resize_limits_file, files_to_resize, "resize_limits")
+
+
+  def resize_limits_file(self, file_path):
+    """Resizes a single image to the limit dimensions. Returns [output, input], or None if the image is within limits."""
+    image = self.open_image(file_path)
+    if self.over_dimensions(image):
+      output_path = self.insert_prefix(self.output_resize_prefix, file_path)
+
+      if not os.path.exists(output_path):
+          if self.file_extension(file_path) == ".gif":
+              return self.resize_limit_gif(file_path, image.width, image.height)
+          elif not self.within_memory_limit(image, file_path, self.limit_ratio(image)):
+            return ["", file_path]
+          else:
+            resized = self.reduce_dimensions(image)
+            self.write_file(output_path, self.encode_image(resized, image.format, optimize=True), resized.size)
+            self.write_siblings(resized, output_path)
+
+          return [output_path, file_path]
+      else:
+          return ["exists", output_path]
+
+    else:
+      print(f"Info: image is within specified limit dimensions: {file_path}")
+      self.metric("skip_reason", "within limits")
+      return None
+
+
+  def resize_directory(self, path_to_directory, only_extensions=[], shard=None):
+    """Attempts to resize all valid files that are above threshold size. shard works as in reduce_directory."""
+
+    temp_extensions = self.extensions
+
+    if len(only_extensions) > 0:
+        self.extensions = only_extensions
+
+    files_to_resize = self.shard_files(self.files_above_threshold(path_to_directory), path_to_directory, shard)
+
+    self.process_files(self.resize_file, files_to_resize, "resize")
+    self.save_shard_results(path_to_directory, shard, "resize")
+
+    if len(only_extensions) > 0:
+        self.extensions = temp_extensions
+
+
+  def best_directory(self, path_to_directory, only_extensions=[], shard=None):
+    """Saves only the smallest version (reduced, resized or both) of each valid file above threshold, using best_prefix.
+    Alternative to reduce_directory + resize_directory + save_only_smallest_modified_files that doesn't write the other versions.
+    shard works as in reduce_directory."""
+
+    temp_extensions = self.extensions
+
+    if len(only_extensions) > 0:
+      self.extensions = only_extensions
+
+    files_to_process = []
+
+    if self.reduce_all_valid_files:
+      files_to_process = self.all_valid_files(path_to_directory)
+    else:
+      files_to_process = self.files_above_threshold(path_to_directory)
+
+    files_to_process = self.shard_files(files_to_process, path_to_directory, shard)
+    self.process_files(self.best_file, files_to_process, "best")
+    self.save_shard_results(path_to_directory, shard, "best")
+
+    if len(only_extensions) > 0:
+      self.extensions = temp_extensions
+
+
+  def shard_files(self, files, path_to_directory, shard):
+    """Files (size, file_path) of shard (index, count), or all of them if shard is None. Each file belongs to the shard
+    given by a hash of its path relative to path_to_directory, so every machine gets the same split of a shared directory
+    (even if it's mounted in a different path) and the shards don't overlap."""
+    if shard is None:
+      return files
+
+    index, count = shard
+    if count < 1 or not 0 <= index < count:
+      raise ValueError(f"Invalid shard {shard}, expected (index, count) with 0 <= index < count.")
+
+    return [(size, file_path) for size, file_path in files if self.shard_of(file_path, path_to_directory, count) == index]
+
+
+  def shard_of(self, file_path, path_to_directory, count):
+    # Generated files go to the shard of their original, so two machines never write the outputs of the same file.
+    original_path = os.path.join(os.path.dirname(file_path), self.trim_prefix(file_path))
+    relative_path = os.path.relpath(original_path, path_to_directory).replace(os.sep, "/")
+    digest = hashlib.sha256(relative_path.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+  def save_shard_results(self, path_to_directory, shard, operation):
+    """Saves the records and summary of the last run as the result of shard (nothing if shard is None), in shard_results_dir
+    or, without it, next to path_to_directory: results don't go inside the directory, where they would be published with it."""
+    if shard is None:
+      return
+
+    index, count = shard
+    results_dir = self.shard_results_dir
+    if results_dir is None:
+      results_dir = os.path.abspath(path_to_directory) + "_shard_results"
+      os.makedirs(results_dir, exist_ok=True)
+      print(f"Shard results saved in {results_dir}.")
+
+    results_path = os.path.join(results_dir, f"shard_{operation}_{index}_of_{count}.json")
+
+    # Write to a temporary file first, so a shard that is interrupted doesn't leave a partial result.
+    temp_path = results_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+      json.dump({"operation": operation, "shard": [index, count], "directory": os.path.abspath(path_to_directory),
+                 "records": self.run_records, "summary": self.run_summary}, file)
+
+    os.replace(temp_path, results_path)
+
+
+  def merge_shard_results(self, results_dir, operation="reduce"):
+    """Joins the results saved by every shard of operation in results_dir. The merged records and summary
+    become the last run (see print_run_summary). Returns {"shards", "missing", "records", "summary"}."""
+    prefix = f"shard_{operation}_"
+    results = []
+
+    for name in sorted(os.listdir(results_dir)):
+      if name.startswith(prefix) and name.endswith(".json"):
+        with open(os.path.join(results_dir, name), "r", encoding="utf-8") as file:
+          results.append(json.load(file))
+
+    counts = set(result["shard"][1] for result in results)
+    if len(counts) > 1:
+      print(f"Warning: results of different shard counts {sorted(counts)} in {results_dir}.")
+
+    count = max(counts) if len(counts) > 0 else 0
+    done = set(result["shard"][0] for result in results if result["shard"][1] == count)
+    missing = [index for index in range(count) if index not in done]
+
+    if len(missing) > 0:
+      print(f"Warning: missing results of shards {missing} (of {count}).")
+
+    records = [record for result in results if result["shard"][1] == count for record in result["records"]]
+
+    self.run_records = records
+    self.run_summary = self.metrics_summary(records)
+
+    return {"shards": count, "missing": missing, "records": records, "summary": self.run_summary}
+
+
+  def srcset_directory(self, path_to_directory, all=False):
+    """Generates the srcset_widths versions (narrower than the original) of each valid original png / jpg
+    above threshold (or of all of them)."""
+    if all:
+      files = self.all_valid_files(path_to_directory)
+    else:
+      files = self.files_above_threshold(path_to_directory)
+
+    # The versions are built from the originals only, not from other generated files (nor from other versions).
+    files = [(size, file_path) for size, file_path in files if not self.file_was_generated(file_path)]
+
+    self.process_files(self.srcset_file, files, "srcset")
+
+
+  def estimate_directory(self, path_to_directory, sample_ratio=0.5, max_files=None, seed=0, sample_method="crop"):
+    """Estimates what reduce_directory would save, and how long it would take, without encoding the full images.
+    Each file is sampled (see estimate_file) and encoded with the current settings, and its size and time are scaled
+    by the number of pixels. With max_files, only a random subset (reproducible with seed) is encoded and the totals
+    are extrapolated by input size. Gifs are not estimated.
+    Returns {"files": [...], "directories": {...}, "total": {...}}, see print_estimate."""
+    if self.reduce_all_valid_files:
+      candidates = self.all_valid_files(path_to_directory)
+    else:
+      candidates = self.files_above_threshold(path_to_directory)
+
+    candidates = [(size, file_path) for size, file_path in candidates if self.file_extension(file_path) != ".gif"]
+
+    sampled = candidates
+    if max_files is not None and len(candidates) > max_files:
+      sampled = random.Random(seed).sample(candidates, max_files)
+
+    files = []
+    for _, file_path in sampled:
+      try:
+        files.append(self.estimate_file(file_path, sample_ratio, sample_method))
+      except Exception as error:
+        print(f"Error: couldn't estimate {file_path}: {error}")
+
+    directories = {}
+    for estimate in files:
+      directory = directories.setdefault(os.path.dirname(estimate["file"]), {"files": 0, "input_bytes": 0, "output_bytes": 0, "seconds": 0})
+      for key in ["input_bytes", "output_bytes", "seconds"]:
+        directory[key] += estimate[key]
+      directory["files"] += 1
+
+    # Files that weren't sampled are assumed to save (and take) the same per input byte as the sampled ones.
+    sampled_bytes = sum(estimate["input_bytes"] for estimate in files)
+    input_bytes = sum(os.path.getsize(file_path) for _, file_path in candidates)
+    scale = input_bytes / sampled_bytes if sampled_bytes > 0 else 0
+
+    total = {
+      "files": len(candidates), "sampled": len(files), "input_bytes": input_bytes,
+      "output_bytes": round(sum(estimate["output_bytes"] for estimate in files) * scale),
+      "seconds": round(sum(estimate["seconds"] for estimate in files) * scale, 2),
+    }
+
+    return {"files": files, "directories": directories, "total": total}
+
+
+  def estimate_file(self, file_path, sample_ratio, sample_method="crop"):
+    """Encodes a sample of file_path like reduce_file would, and scales its size and time to the full image.
+    "crop" (the default) uses its center (sample_ratio of each side) at the output dimensions, keeping the texture
+    (noise, fine detail) that sets the size of photos. "downsample" uses the whole image at sample_ratio of its output
+    dimensions: it's faster (JPEGs are decoded at a reduced scale), but downsampling smooths out that texture, so it
+    underestimates photos (about half their size)."""
+    image = Image.open(file_path)
+
+    # Dimensions reduce_file would write, and memory it would decode.
+    output_ratio = 1
+    if self.resize and self.limit_ratio(image) is not None:
+      output_ratio = self.limit_ratio(image)
+
+    output_size = (max(1, int(image.width * output_ratio)), max(1, int(image.height * output_ratio)))
+    decoded_mb = self.decoded_size_mb(image, output_ratio if output_ratio < 1 else None)
+
+    sample_size = output_size
+    if sample_method == "downsample":
+      sample_size = (max(1, int(output_size[0] * sample_ratio)), max(1, int(output_size[1] * sample_ratio)))
+
+    # Decoding and encoding are timed separately: JPEGs are decoded at a reduced scale (draft), so both scale differently.
+    start = time.perf_counter()
+    image.draft(image.mode, sample_size)
+    image.load()
+    decode_seconds = (time.perf_counter() - start) * decoded_mb / self.decoded_size_mb(image)
+
+    start = time.perf_counter()
+    sample = image
+    if image.size != sample_size:
+      sample = image.resize(sample_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    if sample_method == "crop":
+      width, height = max(1, int(sample.width * sample_ratio)), max(1, int(sample.height * sample_ratio))
+      left, top = (sample.width - width) // 2, (sample.height - height) // 2
+      sample = sample.crop((left, top, left + width, top + height))
+
+    pixels_scale = (output_size[0] * output_size[1]) / (sample.width * sample.height)
+
+    # The threshold is scaled too, so the quality search chooses as it would with the full image.
+    threshold_kb = self.threshold_kb
+    self.threshold_kb = threshold_kb / pixels_scale
+    try:
+      if self.file_extension(file_path) == ".png":
+        _, data = self.encode_png(sample)
+      else:
+        _, data = self.encode_jpg(sample)
+    finally:
+      self.threshold_kb = threshold_kb
+
+    return {
+      "file": file_path, "input_bytes": os.path.getsize(file_path),
+      "output_bytes": round(len(data) * pixels_scale),
+      "seconds": round(decode_seconds + (time.perf_counter() - start) * pixels_scale, 3),
+    }
+
+
+  def print_estimate(self, estimate, by_file=False):
+    total = estimate["total"]
+    saved = total["input_bytes"] - total["output_bytes"]
+    print(f"Estimate for {total['files']} files ({total['sampled']} sampled): "
+          f"{total['input_bytes'] // 1024} kb -> {total['output_bytes'] // 1024} kb ({saved // 1024} kb saved), about {total['seconds']} s.")
+
+    for directory, values in sorted(estimate["directories"].items(), key=lambda item: item[1]["output_bytes"] - item[1]["input_bytes"]):
+      print(f"  [{(values['input_bytes'] - values['output_bytes']) // 1024} kb saved, {round(values['seconds'], 2)} s, {values['files']} files]: {directory}")
+
+    if by_file:
+      for values in estimate["files"]:
+        print(f"    [{values['input_bytes'] // 1024} kb -> {values['output_bytes'] // 1024} kb, {values['seconds']} s]: {values['file']}")
+
+
+  def watch_directory(self, path_to_directory, operation="reduce", interval=2, debounce=2, full_scan_seconds=300, max_polls=None):
+    """Keeps running operation ("reduce", "resize", "resize_limits" or "best") on the valid files that are added to
+    (or modified in) path_to_directory, once they haven't changed for debounce seconds. Files that already existed are
+    not processed (use the directory methods for them), and generated files are ignored.
+    Every interval seconds only the modification time of each directory is checked; directories are listed again only
+    when it changes. Files modified in place don't change it, so every directory is listed every full_scan_seconds
+    (None to never do it, if files are only added).
+    The outputs of a modified file are removed and generated again. Stops after max_polls, or when interrupted."""
+    process_file = {
+      "reduce": self.reduce_file,
+      "resize": self.resize_file,
+      "resize_limits": self.resize_limits_file,
+      "best": self.best_file,
+      "srcset": self.srcset_file,
+    }[operation]
+
+    watcher = DirectoryWatcher(path_to_directory, self)
+    print(f"Watching {path_to_directory} ({len(watcher.directory_mtimes)} directories). Interrupt to stop.")
+
+    polls = 0
+    last_full_scan = time.monotonic()
+
+    try:
+      while max_polls is None or polls < max_polls:
+        time.sleep(interval)
+        polls += 1
+
+        full_scan = full_scan_seconds is not None and time.monotonic() - last_full_scan >= full_scan_seconds
+        if full_scan:
+          last_full_scan = time.monotonic()
+
+        watcher.poll(full_scan)
+
+        files = []
+        for size, file_path, modified in watcher.ready_files(debounce):
+          if size < self.threshold_kb and not self.reduce_all_valid_files:
+            continue
+
+          if modified:
+            self.remove_outputs(file_path, operation)
+
+          files.append((size, file_path))
+
+        if len(files) > 0:
+          self.process_files(process_file, sorted(files, reverse=True), operation)
+    except KeyboardInterrupt:
+      print("Stopped watching.")
+
+
+  def remove_outputs(self, file_path, operation):
+    """Removes the outputs of operation for file_path (and their siblings), so they are generated again."""
+    if operation == "srcset":
+      output_paths = [self.srcset_path(file_path, width) for width in self.srcset_widths]
+    else:
+      prefix = self.best_prefix if operation == "best" else self.output_reduce_prefix if operation == "reduce" else self.output_resize_prefix
+      output_paths = [self.insert_prefix(prefix, file_path)]
+
+    for output_path in output_paths:
+      for path in [output_path] + [output_path + ext for ext in self.modern_formats]:
+        if os.path.exists(path):
+          os.remove(path)
+
+
+  def resize_image(self, path_to_file):
+    """Calls resize function depending on file extension."""
+    result, record = self.measure_file(self.resize_file, path_to_file, "resize")
+    self.clear_snapshots()
+
+    # The record goes to run_records and metrics_sink, like the ones of directories.
+    self.handle_result(path_to_file, result, record, {})
+
+
+  def resize_file(self, path_to_file):
+    """Same as resize_image, but returns [output, input] instead of displaying it. Returns None if file isn't valid."""
+    if not self.valid_file(path_to_file):
+      print(f"Warning: file not valid {path_to_file}.")
+      self.metric("skip_reason", "invalid")
+      return None
+
+    output, input = "", ""
+
+    if self.file_extension(path_to_file) in [".jpg", ".jpeg", ".png"]:
+      output, input= self.resize_png_jpg(path_to_file)
+
+    if self.file_extension(path_to_file) in [".gif"]:
+      output, input = self.resize_gif(path_to_file)
+
+    return [output, input]
+
+  def resize_png_jpg(self, path_to_file):
+    if self.file_extension(path_to_file) not in [".jpg", ".jpeg", ".png"]:
+      print(f"Warning: invalid path for resize_png_jpg, {path_to_file}. Method will skip")
+      return [path_to_file, path_to_file]
+
+    image = self.open_image(path_to_file)
+    output_path = self.insert_prefix(self.output_resize_prefix, path_to_file)
+
+    # Avoid processing an image again.
+    if os.path.exists(output_path):
+        return ["exists", output_path]
+
+    if not self.within_memory_limit(image, path_to_file, self.max_resize):
+      return ["", path_to_file]
+
+    is_png = self.file_extension(path_to_file) == ".png"
+
+    resized_image = self.direct_resize(image, self.max_resize)
+
+    if is_png:
+      resized_data = self.lossless_stage(self.encode_image(resized_image, "PNG", optimize=True), "PNG")
+    else:
+      resized_data = self.encode_image(resized_image, "JPEG", quality=80, optimize=True)
+      resized_data = self.lossless_stage(resized_data, "JPEG", resized_image, 80)
+      self.metric("quality", 80)
+
+    self.write_file(output_path, resized_data, resized_image.size)
+    self.write_siblings(resized_image, output_path)
+
+    return [output_path, path_to_file]
+
+
+  def reduce_image(self, path_to_file):
+    result, record = self.measure_file(self.reduce_file, path_to_file, "reduce")
+    self.clear_snapshots()
+
+    # The record goes to run_records and metrics_sink, like the ones of directories.
+    self.handle_result(path_to_file, result, record, {})
+
+
+  def reduce_file(self, path_to_file):
+    """Same as reduce_image, but returns [output, input] instead of displaying it. Returns None if file isn't valid."""
+    if not self.valid_file(path_to_file):
+      print(f"Warning: file not valid {path_to_file}.")
+      self.metric("skip_reason", "invalid")
+      return None
+
+    output, input = "", ""
+
+    if self.file_extension(path_to_file) in [".jpg", ".jpeg"]:
+      output, input= self.reduce_jpg(path_to_file)
+    elif self.file_extension(path_to_file) in [".png"]:
+      output, input = self.reduce_png(path_to_file)
+    elif self.file_extension(path_to_file) in [".gif"]:
+      output, input = self.reduce_gif(path_to_file)
+
+    return [output, input]
+
+
+  def process_files(self, process_file, files, operation=None):
+    """Calls process_file for each (size, file_path) in files and displays the results.
+    Uses a process pool when workers > 1, and gifs run concurrently (up to gif_workers) in every mode.
+    Results are still displayed in the same order as files, and an error in a concurrent file doesn't stop the rest.
+    If a worker process dies (for example, out of memory), only the file it was processing fails.
+    If manifest_path is set, files already processed with the same operation and options are skipped."""
+    file_paths = [file_path for _, file_path in files]
+
+    self.run_records = []
+    manifest_keys = {}
+    if self.manifest_path is not None and operation is not None:
+      file_paths, manifest_keys = self.files_not_in_manifest(file_paths, operation)
+
+    # Only the first file of each group is processed; the others get a copy of its output (see handle_result).
+    duplicates = {}
+    if self.deduplicate and operation in ["reduce", "resize", "resize_limits", "best"]:
+      groups = self.duplicate_groups(file_paths)
+      duplicates = {group[0]: group[1:] for group in groups}
+      duplicated = set(file_path for group in groups for file_path in group[1:])
+      file_paths = [file_path for file_path in file_paths if file_path not in duplicated]
+
+    # Processing generates files, so current snapshots will be outdated.
+    self.clear_snapshots()
+
+    # Wall clock time, so it's the same deadline in the worker processes. files are largest first, so they get the budget first.
+    self.lossless_deadline = None
+    if self.lossless_run_seconds is not None:
+      self.lossless_deadline = time.time() + self.lossless_run_seconds
+
+    # gifsicle runs in its own process, so gifs only need threads to run concurrently.
+    gif_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.gif_workers))
+    executor = None
+    marker_directory = None
+
+    try:
+      context = self.pool_context()
+
+      # Worker processes are forked before starting gifsicle from any thread. Otherwise they
+      # inherit the pipes of the subprocesses being started, and subprocess.run never returns.
+      futures = [None] * len(file_paths)
+      if self.workers > 1:
+        marker_directory = tempfile.mkdtemp(prefix="reduce_image_")
+        pool_indexes = [i for i, file_path in enumerate(file_paths) if self.file_extension(file_path) != ".gif"]
+        executor = self.submit_to_pool(context, futures, pool_indexes, process_file, file_paths, operation, marker_directory)
+
+      gif_futures = []
+      for i, file_path in enumerate(file_paths):
+        if self.file_extension(file_path) == ".gif":
+          futures[i] = gif_executor.submit(self.measure_file, process_file, file_path, operation)
+          gif_futures.append(futures[i])
+
+      i = 0
+      while i < len(file_paths):
+        file_path, future = file_paths[i], futures[i]
+        try:
+          # Without future, the file is processed here (serial mode).
+          if future is None:
+            result, record = self.measure_file(process_file, file_path, operation)
+          else:
+            result, record = future.result()
+        except concurrent.futures.BrokenExecutor:
+          # A worker process died (killed for using too much memory, or a crash), and with it the pool.
+          executor.shutdown(cancel_futures=True)
+          # New processes are forked once gifsicle isn't running (see above).
+          concurrent.futures.wait(gif_futures)
+          executor = self.recover_pool(context, futures, i, process_file, file_paths, operation, marker_directory)
+          continue
+        except Exception as error:
+          # Duplicates have the same contents, so they get the same error.
+          for failed_path in [file_path] + duplicates.get(file_path, []):
+            print(f"Error: failed to process {failed_path}: {error}")
+            record = self.new_record(failed_path, operation, skip_reason="error", error=str(error))
+            if failed_path != file_path:
+              record["duplicate_of"] = file_path
+            self.emit_record(record)
+          i += 1
+          continue
+
+        self.handle_result(file_path, result, record, manifest_keys, duplicates)
+        i += 1
+
+    finally:
+      gif_executor.shutdown(cancel_futures=True)
+      if executor is not None:
+        executor.shutdown(cancel_futures=True)
+      if marker_directory is not None:
+        shutil.rmtree(marker_directory, ignore_errors=True)
+
+      # The budget is for this run only, not for later calls like reduce_image.
+      self.lossless_deadline = None
+
+      self.clear_snapshots()
+
+      if len(manifest_keys) > 0:
+        self.save_manifest()
+
+      self.run_summary = self.metrics_summary(self.run_records)
+      if self.metrics_sink is not None:
+        self.send_to_sink(self.run_summary)
+
+
+  def pool_context(self):
+    """Multiprocessing context of the process pools. fork allows using the class when it is defined inside a notebook."""
+    if "fork" in multiprocessing.get_all_start_methods():
+      return multiprocessing.get_context("fork")
+
+    return None
+
+
+  def submit_to_pool(self, context, futures, indexes, process_file, file_paths, operation, marker_directory):
+    """Starts a process pool and submits the files of indexes to it (their futures are saved in futures). Returns the pool."""
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    for i in indexes:
+      marker_path = os.path.join(marker_directory, str(i))
+      futures[i] = executor.submit(self.measure_file_in_worker, process_file, file_paths[i], operation, marker_path)
+
+    return executor
+
+
+  def measure_file_in_worker(self, process_file, file_path, operation, marker_path):
+    """measure_file in a worker process. marker_path exists while the file is being processed,
+    so if the process dies, recover_pool knows which file it was processing. The result is also saved
+    in marker_path + ".json", because the pool loses it if another process dies before returning it."""
+    with open(marker_path, "w"):
+      pass
+
+    try:
+      result = self.measure_file(process_file, file_path, operation)
+    finally:
+      os.remove(marker_path)
+
+    with open(marker_path + ".json", "w") as file:
+      json.dump(result, file)
+
+    return result
+
+
+  def recover_pool(self, context, futures, start, process_file, file_paths, operation, marker_directory):
+    """After the pool broke, processes again the files from start that didn't finish. The ones that were being processed
+    when it broke (one of them killed the pool) are processed one by one, each in its own process, so only the file that
+    kills its process fails. The rest go to a new pool, which is returned."""
+    broken = [i for i in range(start, len(futures)) if futures[i] is not None and futures[i].done()
+              and isinstance(futures[i].exception(), concurrent.futures.BrokenExecutor)]
+
+    # Files that finished before the pool broke keep their saved result.
+    for i in broken:
+      result_path = os.path.join(marker_directory, str(i) + ".json")
+      if os.path.exists(result_path):
+        with open(result_path) as file:
+          futures[i] = concurrent.futures.Future()
+          futures[i].set_result(json.load(file))
+    broken = [i for i in broken if futures[i].exception() is not None]
+
+    suspects = [i for i in broken if os.path.exists(os.path.join(marker_directory, str(i)))]
+    if len(suspects) == 0:
+      suspects = broken
+
+    print(f"Warning: a worker process died, processing {len(suspects)} files separately and {len(broken) - len(suspects)} again.")
+
+    for i in suspects:
+      futures[i] = self.measure_file_isolated(context, process_file, file_paths[i], operation)
+
+    return self.submit_to_pool(context, futures, [i for i in broken if i not in suspects], process_file, file_paths, operation, marker_directory)
+
+
+  def measure_file_isolated(self, context, process_file, file_path, operation):
+    """measure_file in a new process used only for file_path. Returns a finished future with the result (or the error)."""
+    future = concurrent.futures.Future()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+      try:
+        future.set_result(executor.submit(self.measure_file, process_file, file_path, operation).result())
+      except concurrent.futures.BrokenExecutor:
+        future.set_exception(RuntimeError("the worker process died (out of memory or crashed)"))
+      except Exception as error:
+        future.set_exception(error)
+
+    return future
+
+
+  def handle_result(self, file_path, result, record, manifest_keys, duplicates={}):
+    self.emit_record(record)
+
+    if result is not None:
+      self.display_result(*result, record)
+
+      if file_path in manifest_keys:
+        self.record_in_manifest(manifest_keys[file_path], file_path, *result)
+
+    for duplicate in duplicates.get(file_path, []):
+      copy_result = lambda path: self.copy_duplicate_result(file_path, path, result, record)
+      self.handle_result(duplicate, *self.measure_file(copy_result, duplicate, record["operation"]), manifest_keys)
+
+
+  def copy_duplicate_result(self, representative, duplicate, result, representative_record):
+    """Copies the output of representative (result of processing it) as the output of duplicate,
+    with the same prefix. Returns [output, input] like the other process_file methods."""
+    self.metric("duplicate_of", representative)
+
+    if result is None:
+      self.metric("skip_reason", representative_record["skip_reason"])
+      return None
+
+    output, input = result
+
+    if output == "" or input == "":
+      return ["", duplicate]
+    if output == input:
+      return [duplicate, duplicate]
+
+    # With "exists", input is the path of the existing output.
+    representative_output = input if output == "exists" else output
+    prefix = os.path.basename(representative_output)[:-len(os.path.basename(representative))]
+    output_path = self.insert_prefix(prefix, duplicate)
+
+    if os.path.exists(output_path):
+      return ["exists", output_path]
+
+    start = time.perf_counter()
+    shutil.copyfile(representative_output, output_path)
+    for ext in self.modern_formats:
+      if os.path.exists(representative_output + ext) and not os.path.exists(output_path + ext):
+        shutil.copyfile(representative_output + ext, output_path + ext)
+    self.add_seconds("write_seconds", start)
+
+    for key in ["input_width", "input_height", "output_width", "output_height", "quality", "colors", "candidate"]:
+      self.metric(key, representative_record[key])
+
+    return [output_path, duplicate]
+
+
+  def files_not_in_manifest(self, file_paths, operation):
+    """Returns the files that haven't been processed with the current options,
+    and a dictionary with the manifest key of each of them."""
+    self.load_manifest()
+
+    pending_files = []
+    manifest_keys = {}
+
+    for file_path in file_paths:
+      key = self.manifest_key(file_path, operation)
+
+      if key in self.manifest["results"]:
+        print(f"Info: skipping, file already processed (manifest) {file_path}.")
+        self.emit_record(self.new_record(file_path, operation, skip_reason="manifest"))
+        continue
+
+      pending_files.append(file_path)
+      manifest_keys[file_path] = key
+
+    return pending_files, manifest_keys
+
+
+  def duplicate_groups(self, file_paths):
+    """Groups of file_paths with the same image: identical content, or the same dimensions, type and dHash (up to
+    duplicate_distance different bits) with nearly identical thumbnails. Each group is a list of paths (in the order
+    of file_paths) with at least two files; the first one is the representative."""
+    order = {file_path: i for i, file_path in enumerate(file_paths)}
+    self.load_manifest()
+
+    # Exact copies: same size, then same sha256.
+    by_size = {}
+    for file_path in file_paths:
+      by_size.setdefault((self.image_type(file_path), os.path.getsize(file_path)), []).append(file_path)
+
+    exact_groups = {}
+    for (image_type, _), paths in by_size.items():
+      for file_path in paths:
+        key = (image_type, self.content_hash(file_path)) if len(paths) > 1 else file_path
+        exact_groups.setdefault(key, []).append(file_path)
+
+    groups = list(exact_groups.values())
+
+    if self.duplicate_distance > 0:
+      groups = self.merge_similar_groups(groups)
+
+    groups = [sorted(group, key=lambda file_path: order[file_path]) for group in groups if len(group) > 1]
+    return sorted(groups, key=lambda group: order[group[0]])
+
+
+  def merge_similar_groups(self, groups):
+    """Merges the groups whose first images are perceptually the same (see duplicate_groups). Gifs aren't compared.
+    With workers > 1, the images are decoded in a process pool."""
+    candidates = [group for group in groups if self.file_extension(group[0]) != ".gif"]
+
+    # Runs before process_files starts gifsicle, so forking is safe (see process_files).
+    executor = None
+    futures = [None] * len(candidates)
+    if self.workers > 1 and len(candidates) > 1:
+      executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=self.pool_context())
+      futures = [executor.submit(self.image_fingerprint, group[0]) for group in candidates]
+
+    fingerprints = []
+    try:
+      for group, future in zip(candidates, futures):
+        try:
+          fingerprint = self.image_fingerprint(group[0]) if future is None else future.result()
+        except Exception as error:
+          print(f"Warning: couldn't compare {group[0]}: {error}")
+          continue
+
+        if fingerprint is not None:
+          fingerprints.append((group, *fingerprint))
+    finally:
+      if executor is not None:
+        executor.shutdown(cancel_futures=True)
+
+    if len(fingerprints) == 0:
+      return groups
+
+    # dHash of all the images at once: 64 bits, whether each pixel of a 9x8 gray thumbnail is brighter than the next one.
+    gray = np.stack([fingerprint[3] for fingerprint in fingerprints]).astype(np.int16)
+    bits = (gray[:, :, 1:] > gray[:, :, :-1]).reshape(len(fingerprints), 64)
+    hashes = [int.from_bytes(packed.tobytes(), "big") for packed in np.packbits(bits, axis=1)]
+
+    # Images within duplicate_distance bits share at least one of duplicate_distance + 1 bands exactly,
+    # so only images that share a band are compared.
+    band_count = self.duplicate_distance + 1
+    band_bits = math.ceil(64 / band_count)
+    buckets = {}
+    for i, image_hash in enumerate(hashes):
+      for band in range(band_count):
+        key = (band, (image_hash >> (band * band_bits)) & ((1 << band_bits) - 1))
+        buckets.setdefault(key, []).append(i)
+
+    merged = set()
+    for i, (group, key, thumbnail, _) in enumerate(fingerprints):
+      if id(group) in merged:
+        continue
+
+      neighbors = set()
+      for band in range(band_count):
+        neighbors.update(buckets[(band, (hashes[i] >> (band * band_bits)) & ((1 << band_bits) - 1))])
+
+      for j in sorted(neighbors):
+        other_group, other_key, other_thumbnail, _ = fingerprints[j]
+        if j <= i or id(other_group) in merged or other_key != key:
+          continue
+
+        if bin(hashes[i] ^ hashes[j]).count("1") > self.duplicate_distance:
+          continue
+
+        # Same structure isn't enough (dHash ignores color), the thumbnails must be nearly identical too.
+        if np.abs(thumbnail - other_thumbnail).mean() > 2:
+          continue
+
+        group.extend(other_group)
+        merged.add(id(other_group))
+
+    return [group for group in groups if id(group) not in merged]
+
+
+  def image_fingerprint(self, file_path):
+    """(type and dimensions, 16x16 RGBA thumbnail, 9x8 gray thumbnail) of the image, or None if it's above max_image_mb."""
+    image = Image.open(file_path)
+    key = (self.image_type(file_path), image.size)
+
+    if self.max_image_mb is not None and self.decoded_size_mb(image, 16 / max(image.size)) > self.max_image_mb:
+      return None
+
+    image.draft("RGB", (16, 16))
+    if image.mode not in ["RGB", "RGBA", "L"]:
+      image = image.convert("RGBA")
+
+    thumbnail = image.resize((16, 16), Image.Resampling.BOX, reducing_gap=2.0).convert("RGBA")
+    gray = thumbnail.convert("L").resize((9, 8), Image.Resampling.BOX)
+    return (key, np.asarray(thumbnail, dtype=np.float32), np.asarray(gray))
+
+
+  def image_type(self, file_path):
+    """Extension, with .jpeg as .jpg. Only files of the same type are duplicates (their outputs are interchangeable)."""
+    ext = self.file_extension(file_path).lower()
+    return ".jpg" if ext == ".jpeg" else ext
+
+
+  def print_duplicate_groups(self, path_to_directory):
+    """Prints the groups of duplicated original images (see duplicate_groups) and the space they use."""
+    files = [file_path for _, file_path in self.all_valid_files(path_to_directory) if not self.file_was_generated(file_path)]
+    groups = self.duplicate_groups(files)
+
+    if len(groups) == 0:
+      print("No duplicated images found.")
+      return
+
+    redundant_kb = sum(self.get_file_size_kb(file_path) for group in groups for file_path in group[1:])
+    print(f"{len(groups)} groups of duplicated images, {redundant_kb} kb in copies.")
+    for group in groups:
+      print(f"[{len(group)} copies, {self.get_file_size_kb(group[0])} kb]: {group[0]}")
+      for file_path in group[1:]:
+        print(f"    {file_path}")
+
+
+  def manifest_key(self, file_path, operation):
+    """Hash of the file contents plus the options that affect the output of operation."""
+    options = [operation, self.threshold_kb, self.min_quality, self.colors_png, self.resize,
+               self.adaptive_png, self.min_colors_png, self.png_quantizer, self.min_ssim,
+               self.modern_formats, self.webp_quality, self.avif_quality, self.srcset_widths,
+               self.max_img_width_px, self.max_img_height_px, self.max_resize,
+               self.colors_, self.scale_ratio, self.lossiness_factor, self.classify, self.lossless_seconds]
+
+    options_hash = hashlib.sha256(json.dumps(options).encode()).hexdigest()[:16]
+    return f"{self.content_hash(file_path)}:{options_hash}"
+
+
+  def content_hash(self, file_path):
+    """sha256 of the file. Reuses the hash stored in the manifest if size and mtime didn't change."""
+    stat = os.stat(file_path)
+    file_key = os.path.abspath(file_path)
+    cached = self.manifest["hashes"].get(file_key)
+
+    if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+      return cached["hash"]
+
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+      for chunk in iter(lambda: file.read(1024 * 1024), b""):
+        sha.update(chunk)
+
+    content_hash = sha.hexdigest()
+    self.manifest["hashes"][file_key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": content_hash}
+    return content_hash
+
+
+  def record_in_manifest(self, key, file_path, output, input):
+    if output == "" or input == "":
+      return
+
+    # With "exists", input is the path of the existing output.
+    output_path = input if output == "exists" else output
+
+    self.manifest["results"][key] = {
+      "input": os.path.abspath(file_path),
+      "output": os.path.abspath(output_path),
+      "input_kb": self.get_file_size_kb(file_path),
+      "output_kb": self.get_file_size_kb(output_path) if os.path.exists(output_path) else None,
+    }
+
+
+  def load_manifest(self):
+    if self.manifest is not None:
+      return
+
+    self.manifest = {"hashes": {}, "results": {}}
+
+    if self.manifest_path is not None and os.path.exists(self.manifest_path):
+      with open(self.manifest_path, "r", encoding="utf-8") as file:
+        self.manifest.update(json.load(file))
+
+
+  def save_manifest(self):
+    if self.manifest_path is None or self.manifest is None:
+      return
+
+    # Write to a temporary file first, so an interrupted run doesn't corrupt the manifest.
+    temp_path = self.manifest_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+      json.dump(self.manifest, file)
+
+    os.replace(temp_path, self.manifest_path)
+
+
+  def measure_file(self, process_file, file_path, operation=None):
+    """Calls process_file(file_path) and collects the metrics of the file while it runs. Returns [result, record]."""
+    record = self.new_record(file_path, operation)
+    thread_id = threading.get_ident()
+    self.current_records[thread_id] = record
+    start = time.perf_counter()
+
+    try:
+      result = process_file(file_path)
+    finally:
+      record["total_seconds"] = round(time.perf_counter() - start, 4)
+      del self.current_records[thread_id]
+
+    if result is not None:
+      output, input = result
+
+      if output == "exists":
+        record["skip_reason"] = "exists"
+        record["output"] = input
+      elif output == "" or input == "":
+        if record["skip_reason"] is None:
+          record["skip_reason"] = "not processed"
+      elif output == input:
+        record["skip_reason"] = "unsupported"
+      else:
+        record["output"] = output
+        record["output_bytes"] = os.path.getsize(output)
+
+    return [result, record]
+
+
+  def new_record(self, file_path, operation=None, skip_reason=None, error=None):
+    return {
+      "type": "file", "file": file_path, "operation": operation, "output": None,
+      "input_bytes": os.path.getsize(file_path) if os.path.exists(file_path) else None, "output_bytes": None,
+      "input_width": None, "input_height": None, "output_width": None, "output_height": None,
+      "quality": None, "colors": None, "candidate": None, "ssim": None, "siblings": None, "srcset": None, "duplicate_of": None,
+      "image_class": None, "strategy": None, "lossless": None,
+      "decode_seconds": 0.0, "encode_seconds": 0.0, "write_seconds": 0.0, "total_seconds": 0.0,
+      "skip_reason": skip_reason, "error": error,
+    }
+
+
+  def metric(self, key, value):
+    """Saves value in the record of the file being processed by this thread (if any)."""
+    record = self.current_records.get(threading.get_ident())
+    if record is not None:
+      record[key] = value
+
+
+  def add_seconds(self, key, start):
+    """Adds the time since start (time.perf_counter) to key in the current record."""
+    record = self.current_records.get(threading.get_ident())
+    if record is not None:
+      record[key] = round(record[key] + time.perf_counter() - start, 4)
+
+
+  def emit_record(self, record):
+    self.run_records.append(record)
+
+    if self.metrics_sink is not None:
+      self.send_to_sink(record)
+
+
+  def send_to_sink(self, record):
+    if isinstance(self.metrics_sink, list):
+      self.metrics_sink.append(record)
+    elif isinstance(self.metrics_sink, str):
+      with open(self.metrics_sink, "a", encoding="utf-8") as file:
+        file.write(json.dumps(record) + "\n")
+    else:
+      self.metrics_sink(record)
+
+
+  def metrics_summary(self, records):
+    """Totals of the records and percentiles of their times. Files that were skipped only count in the totals."""
+    processed = [record for record in records if record["skip_reason"] is None and record["output_bytes"] is not None]
+    input_bytes = sum(record["input_bytes"] for record in processed)
+    output_bytes = sum(record["output_bytes"] for record in processed)
+
+    skipped = {}
+    for record in records:
+      if record["skip_reason"] is not None:
+        skipped[record["skip_reason"]] = skipped.get(record["skip_reason"], 0) + 1
+
+    summary = {
+      "type": "summary", "files": len(records), "processed": len(processed), "skipped": skipped,
+      "input_bytes": input_bytes, "output_bytes": output_bytes, "saved_bytes": input_bytes - output_bytes,
+    }
+
+    for key in ["total_seconds", "decode_seconds", "encode_seconds", "write_seconds"]:
+      values = sorted(record[key] for record in processed)
+      summary[key] = round(sum(values), 4)
+
+      for percentile in [50, 90, 99]:
+        summary[f"{key}_p{percentile}"] = self.percentile(values, percentile)
+
+    return summary
+
+
+  def percentile(self, sorted_values, percentile):
+    """Nearest-rank percentile of an already sorted list."""
+    if len(sorted_values) == 0:
+      return None
+
+    rank = math.ceil(percentile / 100 * len(sorted_values))
+    return sorted_values[max(0, rank - 1)]
+
+
+  def print_run_summary(self, slowest=5):
+    """Prints the summary of the last run and its slowest files."""
+    if self.run_summary is None:
+      print("No run summary available.")
+      return
+
+    summary = self.run_summary
+    print(f"{summary['processed']} of {summary['files']} files processed. Skipped: {summary['skipped']}")
+    print(f"{summary['input_bytes'] // 1024} kb -> {summary['output_bytes'] // 1024} kb ({summary['saved_bytes'] // 1024} kb saved)")
+    print(f"Seconds per file: p50 {summary['total_seconds_p50']}, p90 {summary['total_seconds_p90']}, p99 {summary['total_seconds_p99']}")
+
+    records = sorted(self.run_records, key=lambda record: record["total_seconds"], reverse=True)
+    for record in records[:slowest]:
+      print(f"  {record['total_seconds']} s: {record['file']}")
+
+
+  def display_result(self, output, input, record=None):
+    if output == "" or input == "":
+      print(f"Info: file not processed {input}.")
+    elif output == "exists":
+      print(f"Info: skipping, file already exists {input}.")
+    else:
+      out_size = self.get_file_size_kb(output)
+      in_size = self.get_file_size_kb(input)
+
+      percentage = (out_size / in_size) * 100
+      print(f"[{round(100 - percentage, 2)}% reduction | {in_size} kb -> {out_size} kb: {output}]")
+
+      self.was_resized(output, input, record)
+
+      if percentage == 100:
+        print(f"Warning: file size unchanged for {output}.")
+      if percentage > 100:
+        print(f"WARNING: file size INCREASED for {output}.")
+      if percentage < 100 and out_size > self.threshold_kb:
+        print(f"Warning: file size reduced but image remains above threshold for {output}.")
+
+  def was_resized(self, output_path, input_file, record=None):
+    if os.path.basename(output_path).startswith(self.output_resize_prefix):
+        # Use the dimensions from the metrics record when available, instead of opening both images.
+        if record is not None and record["output_width"] is not None and record["input_width"] is not None:
+          print(f"Output: {record['output_width']} w {record['output_height']} h, Input: {record['input_width']} w {record['input_height']} h")
+          return
+
+        input_image = Image.open(input_file)
+        output_image = Image.open(output_path)
+        print(f"Output: {output_image.width} w {output_image.height} h, Input: {input_image.width} w {input_image.height} h")
+
+
+  def reduce_png(self, path_to_file):
+    if self.file_extension(path_to_file) not in [".png"]:
+      print(f"Warning: invalid path for reduce_png, {path_to_file}. Method will skip")
+      return [path_to_file, path_to_file]
+
+    image = self.open_image(path_to_file)
+
+    output_path = self.insert_prefix(self.output_reduce_prefix, path_to_file)
+
+    if os.path.exists(output_path):
+        return ["exists", output_path]
+
+    if not self.within_memory_limit(image, path_to_file):
+      return ["", path_to_file]
+
+    self.load_image(image)
+    reduced_png = image
+
+    # Neither resizing nor quantizing modify image, so it doesn't need to be copied.
+    if self.resize:
+      reduced_png = self.reduce_dimensions(image)
+
+    # PNG saving options: https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#png
+    colors, png_data = self.encode_png(reduced_png)
+    png_data = self.lossless_stage(png_data, "PNG")
+    self.metric("colors", colors)
+
+    self.write_file(output_path, png_data, reduced_png.size)
+    self.write_siblings(reduced_png, output_path)
+    return [output_path, path_to_file]
+
+
+  def supported_formats(self, formats):
+    """Formats of modern_formats that this Pillow build can save."""
+    supported = []
+    for ext in formats:
+      ext = ext if ext.startswith(".") else "." + ext
+
+      if Image.registered_extensions().get(ext.lower()) in ["WEBP", "AVIF"]:
+        supported.append(ext.lower())
+      else:
+        print(f"Warning: Pillow can't save {ext} files, they won't be generated.")
+
+    return supported
+
+
+  def write_siblings(self, image, output_path):
+    """Saves image in each of modern_formats next to output_path (output_path + extension).
+    Existing siblings are not overwritten."""
+    siblings = {}
+
+    for ext in self.modern_formats:
+      sibling_path = output_path + ext
+      if os.path.exists(sibling_path):
+        continue
+
+      if ext == ".webp" and self.classify and self.classify_image(image) == "graphic":
+        data = self.encode_image(image, "WEBP", lossless=True, method=4)
+      elif ext == ".webp":
+        data = self.encode_image(image, "WEBP", quality=self.webp_quality, method=6)
+      else:
+        data = self.encode_image(image, "AVIF", quality=self.avif_quality)
+
+      start = time.perf_counter()
+      with open(sibling_path, "wb") as sibling_file:
+        sibling_file.write(data)
+      self.add_seconds("write_seconds", start)
+
+      siblings[ext] = len(data)
+
+    if len(siblings) > 0:
+      self.metric("siblings", siblings)
+
+
+  def encode_png(self, image):
+    """Quantizes and encodes image with the colors chosen by min_ssim, adaptive_png or colors_png (in that order).
+    With classify, photos aren't quantized (colors is None) if that is enough to get below threshold_kb.
+    Returns [colors, png bytes]."""
+    if self.min_ssim is not None:
+      return self.search_png_ssim(image)
+
+    # A palette causes banding in photos, so they are only compressed without loss, unless it isn't enough.
+    if self.classify and self.classify_image(image) == "photo":
+      data = self.encode_image(image, "PNG", optimize=True)
+      if self.bytes_to_kb(len(data)) <= self.threshold_kb:
+        self.metric("strategy", "lossless")
+        return [None, data]
+
+    self.metric("strategy", "palette")
+
+    if self.adaptive_png:
+      return self.search_png_colors(image)
+
+    return [self.colors_png, self.encode_image(self.quantize_png(image, self.colors_png), "PNG", optimize=True)]
+
+
+  def search_png_ssim(self, image):
+    """Fewest colors (256 down to min_colors_png, halving each time) whose SSIM with image is at least min_ssim.
+    If no palette reaches it, 256 colors are used. Returns [colors, png bytes]."""
+    reference = self.luma_plane(image)
+    chosen_colors, chosen = 256, None
+    colors = 256
+
+    while colors >= max(2, self.min_colors_png):
+      quantized = self.quantize_png(image, colors)
+      similarity = self.ssim(reference, self.luma_plane(quantized, reference.shape))
+
+      if similarity < self.min_ssim and chosen is not None:
+        break
+
+      chosen_colors, chosen = colors, quantized
+      self.metric("ssim", round(similarity, 4))
+
+      if similarity < self.min_ssim:
+        break
+
+      colors //= 2
+
+    return [chosen_colors, self.encode_image(chosen, "PNG", optimize=True)]
+
+
+  def search_png_colors(self, image):
+    """Tries palettes from 256 colors down to min_colors_png (halving each time), in memory, and
+    keeps the first one whose output is below threshold_kb. If none fits, the smallest output is used.
+    Returns [colors, png bytes]."""
+    best_colors, best_data = None, None
+    colors = 256
+
+    while colors >= max(2, self.min_colors_png):
+      data = self.encode_image(self.quantize_png(image, colors), "PNG", optimize=True)
+
+      if best_data is None or len(data) < len(best_data):
+        best_colors, best_data = colors, data
+
+      if self.bytes_to_kb(len(data)) <= self.threshold_kb:
+        return [colors, data]
+
+      colors //= 2
+
+    return [best_colors, best_data]
+
+
+  def quantize_png(self, image, colors):
+    """Reduces image to colors using the png_quantizer method.
+    https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.quantize"""
+    method = self.quantize_method(image)
+
+    start = time.perf_counter()
+    quantized = image.quantize(colors=colors, method=method)
+    self.add_seconds("encode_seconds", start)
+
+    return quantized
+
+
+  def resolve_quantizer(self, png_quantizer):
+    """Specific method ("mediancut", "maxcoverage", "fastoctree", "libimagequant" or None) for png_quantizer,
+    with the methods this Pillow build supports."""
+    quantizer = png_quantizer
+    if quantizer == "fast":
+      quantizer = "fastoctree"
+    elif quantizer == "quality":
+      quantizer = "libimagequant" if features.check_feature("libimagequant") else "mediancut"
+
+    if quantizer == "libimagequant" and not features.check_feature("libimagequant"):
+      print("Warning: Pillow was built without libimagequant, using fast octree.")
+      quantizer = "fastoctree"
+
+    return quantizer
+
+
+  def quantize_method(self, image):
+    """Pillow quantize method for png_quantizer (resolved in quantizer). None uses Pillow's default."""
+    methods = {
+      "mediancut": Image.Quantize.MEDIANCUT,
+      "maxcoverage": Image.Quantize.MAXCOVERAGE,
+      "fastoctree": Image.Quantize.FASTOCTREE,
+      "libimagequant": Image.Quantize.LIBIMAGEQUANT,
+    }
+
+    quantizer = self.quantizer
+    if quantizer is None:
+      return None
+
+    # Other modes (like P) are left to Pillow's default.
+    if image.mode not in ["RGB", "RGBA", "L"]:
+      return None
+
+    # Median cut and max coverage don't support transparency.
+    if image.mode == "RGBA" and quantizer in ["mediancut", "maxcoverage"]:
+      quantizer = "fastoctree"
+
+    return methods[quantizer]
+
+
+  def reduce_jpg(self, path_to_file):
+    if self.file_extension(path_to_file) not in [".jpg", ".jpeg"]:
+      print(f"Warning: invalid path for reduce_jpg, {path_to_file}. Method will skip")
+      return [path_to_file, path_to_file]
+
+    output_path = self.insert_prefix(self.output_reduce_prefix, path_to_file)
+
+    if os.path.exists(output_path):
+        return ["exists", output_path]
+
+    image = self.open_image(path_to_file)
+
+    resize_ratio = self.limit_ratio(image) if self.resize else None
+    if not self.within_memory_limit(image, path_to_file, resize_ratio):
+      return ["", path_to_file]
+
+    reduced_jpg = image
+
+    # The image isn't loaded yet, so reduce_dimensions can decode it at a reduced scale.
+    if self.resize:
+      reduced_jpg = self.reduce_dimensions(image)
+    else:
+      self.load_image(image)
+
+    # JPEG saving options: https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#jpeg-saving
+    quality, jpg_data = self.encode_jpg(reduced_jpg)
+    jpg_data = self.lossless_stage(jpg_data, "JPEG", reduced_jpg, quality)
+    self.metric("quality", quality)
+
+    # Only write to disk once, with the chosen quality.
+    self.write_file(output_path, jpg_data, reduced_jpg.size)
+    self.write_siblings(reduced_jpg, output_path)
+
+    return [output_path, path_to_file]
+
+
+  def encode_jpg(self, image):
+    """Encodes image with the quality chosen by min_ssim or, without it, by threshold_kb. Returns [quality, jpg bytes]."""
+    if self.min_ssim is not None:
+      return self.search_jpg_ssim(image)
+
+    if self.classify and self.classify_image(image) == "graphic":
+      self.metric("strategy", "two qualities")
+      return self.quick_jpg_quality(image)
+
+    self.metric("strategy", "quality search")
+    return self.search_jpg_quality(image)
+
+
+  def quick_jpg_quality(self, image, initial_quality=90):
+    """For graphics, whose size barely changes with quality: initial_quality if it's below threshold_kb,
+    otherwise min_quality. Returns [quality, jpg bytes]."""
+    data = self.encode_image(image, "JPEG", optimize=True, quality=initial_quality)
+
+    if self.bytes_to_kb(len(data)) <= self.threshold_kb:
+      return [initial_quality, data]
+
+    return [self.min_quality, self.encode_image(image, "JPEG", optimize=True, quality=self.min_quality)]
+
+
+  def classify_image(self, image, max_side=128):
+    """"graphic" or "photo", from a thumbnail of image (at most max_side, without mixing colors). Graphics have
+    few colors, or large flat areas (identical neighbor pixels), or many sharp edges (text, line art) or transparency
+    (icons, logos) without many colors. The measures are saved in the image_class metric, and the versions of the
+    file being processed (resized, siblings, candidates) reuse them instead of classifying again."""
+    record = self.current_records.get(threading.get_ident())
+    if record is not None and record["image_class"] is not None:
+      return record["image_class"]["class"]
+
+    scale = min(1, max_side / max(image.width, image.height))
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    thumbnail = image.resize(size, Image.Resampling.NEAREST)
+
+    if thumbnail.mode not in ["RGB", "RGBA"]:
+      thumbnail = thumbnail.convert("RGBA")
+
+    pixels = np.asarray(thumbnail).astype(np.uint32)
+    alpha = pixels[..., 3] if thumbnail.mode == "RGBA" else np.full(pixels.shape[:2], 255, dtype=np.uint32)
+    packed = (pixels[..., 0] << 24) | (pixels[..., 1] << 16) | (pixels[..., 2] << 8) | alpha
+    # The color of transparent pixels isn't visible, so they are all the same.
+    packed[alpha == 0] = 0
+
+    luma = pixels[..., :3] @ np.array([0.299, 0.587, 0.114])
+    same = np.concatenate([(packed[:, 1:] == packed[:, :-1]).ravel(), (packed[1:] == packed[:-1]).ravel()])
+    edges = np.concatenate([(np.abs(np.diff(luma, axis=1)) > 32).ravel(), (np.abs(np.diff(luma, axis=0)) > 32).ravel()])
 
-    if len(self.output_resize_prefix) == 0:
-      self.output_resize_prefix = "R_"
+    measures = {
+      "colors": int(len(np.unique(packed))),
+      "flat": round(float(same.mean()), 3) if same.size > 0 else 1.0,
+      "edges": round(float(edges.mean()), 3) if edges.size > 0 else 0.0,
+      "alpha": bool((alpha < 255).any()),
+    }
 
-    if len(self.best_prefix) == 0:
-      self.best_prefix = "B_"
+    is_graphic = (measures["colors"] <= 256 or measures["flat"] >= 0.5
+                  or ((measures["edges"] >= 0.2 or measures["alpha"]) and measures["colors"] <= 4096))
+    measures["class"] = "graphic" if is_graphic else "photo"
 
-    # Solo se usa con resize_directory
-    self.max_resize = max_resize
+    self.metric("image_class", measures)
+    return measures["class"]
 
-    # Opciones para gifs
-    self.colors_= colors_
-    self.scale_ratio = scale_ratio
-    self.lossiness_factor = lossiness_factor
 
+  def search_jpg_ssim(self, image, initial_quality=90):
+    """Binary search (in memory) of the lowest quality between min_quality and initial_quality whose SSIM with image
+    is at least min_ssim. If no quality reaches it, initial_quality is used. Returns [quality, jpg bytes]."""
+    reference = self.luma_plane(image)
+    best_quality, best_data, best_ssim = None, None, None
 
-  def reduce_directory(self, path_to_directory, only_extensions=[]):
+    low = min(self.min_quality, initial_quality)
+    high = initial_quality
 
-    temp_extensions = self.extensions
+    while low <= high:
+      quality = (low + high) // 2
+      data = self.encode_image(image, "JPEG", optimize=True, quality=quality)
+      similarity = self.ssim(reference, self.encoded_luma_plane(data, reference.shape))
 
-    # Temporarily limit the extensions to consider
-    if len(only_extensions) > 0:
-      self.extensions = only_extensions
+      if similarity >= self.min_ssim:
+        best_quality, best_data, best_ssim = quality, data, similarity
+        high = quality - 1
+      else:
+        low = quality + 1
 
-    files_to_reduce = []
+    if best_data is None:
+      best_quality = initial_quality
+      best_data = self.encode_image(image, "JPEG", optimize=True, quality=initial_quality)
+      best_ssim = self.ssim(reference, self.encoded_luma_plane(best_data, reference.shape))
 
-    if self.reduce_all_valid_files:
-      files_to_reduce = self.all_valid_files(path_to_directory)
-    else:
-      files_to_reduce = self.files_above_threshold(path_to_directory)
+    self.metric("ssim", round(best_ssim, 4))
+    return [best_quality, best_data]
 
-    for size, file_path in files_to_reduce:
-      self.reduce_image(file_path)
 
-    # Restore the extensions to consider
-    if len(only_extensions) > 0:
-      self.extensions = temp_extensions
+  def luma_plane(self, image, shape=None, max_side=256, max_reduction=2):
+    """Luma (L) of image, downscaled so its longest side is max_side (or to shape, as (height, width)), as a float array.
+    It is reduced at most max_reduction times, because a stronger reduction averages away jpg blocking and SSIM misses it."""
+    if shape is None:
+      scale = min(1, max(1 / max_reduction, max_side / max(image.width, image.height)))
+      shape = (max(1, round(image.height * scale)), max(1, round(image.width * scale)))
 
+    luma = image.convert("L")
+    if luma.size != (shape[1], shape[0]):
+      luma = luma.resize((shape[1], shape[0]), Image.Resampling.BOX, reducing_gap=2.0)
 
-  def resize_limits_directory(self, path_to_directory, all=False):
-    """Only resizes valid images to max width or max height specified."""
-    files_to_resize=[]
-    if all:
-      files_to_resize = self.all_valid_files(path_to_directory)
-    else:
-      files_to_resize = self.files_above_threshold(path_to_directory)
+    return np.asarray(luma, dtype=np.float64)
 
-    for size, file_path in files_to_resize:
-      image = Image.open(file_path)
-      if self.over_dimensions(image):
-        output_path = self.insert_prefix(self.output_resize_prefix, file_path)
 
-        if not os.path.exists(output_path):
-            if self.file_extension(file_path) == ".gif":
-                self.resize_limit_gif(file_path, image.width, image.height)
-            else:
-              resized = self.reduce_dimensions(image)
-              resized.save(output_path, optimize=True)
+  def encoded_luma_plane(self, data, shape):
+    """Same as luma_plane, for encoded jpg bytes. Decodes only the luma, at a reduced scale (draft)."""
+    encoded = Image.open(io.BytesIO(data))
+    encoded.draft("L", (shape[1], shape[0]))
+    return self.luma_plane(encoded, shape)
 
-            self.display_result(output_path, file_path)
-        else:
-            self.display_result("exists", output_path)
 
-      else:
-        print(f"Info: image is within specified limit dimensions: {file_path}")
+  def ssim(self, plane_a, plane_b, window=7):
+    """Mean structural similarity between two luma planes of the same shape.
+    Uses a uniform window, computed with summed-area tables so everything is vectorized."""
+    if min(plane_a.shape) < window:
+      window = min(plane_a.shape)
 
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
 
-  def resize_directory(self, path_to_directory, only_extensions=[]):
-    """Attempts to resize all valid files that are above threshold size."""
+    mean_a = self.window_mean(plane_a, window)
+    mean_b = self.window_mean(plane_b, window)
+    variance_a = self.window_mean(plane_a * plane_a, window) - mean_a * mean_a
+    variance_b = self.window_mean(plane_b * plane_b, window) - mean_b * mean_b
+    covariance = self.window_mean(plane_a * plane_b, window) - mean_a * mean_b
 
-    temp_extensions = self.extensions
+    numerator = (2 * mean_a * mean_b + c1) * (2 * covariance + c2)
+    denominator = (mean_a * mean_a + mean_b * mean_b + c1) * (variance_a + variance_b + c2)
+    return float(np.mean(numerator / denominator))
 
-    if len(only_extensions) > 0:
-        self.extensions = only_extensions
 
-    files_to_resize = self.files_above_threshold(path_to_directory)
+  def window_mean(self, plane, window):
+    """Mean of every window x window block of plane (valid positions only)."""
+    table = np.pad(plane.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    total = table[window:, window:] - table[:-window, window:] - table[window:, :-window] + table[:-window, :-window]
+    return total / (window * window)
 
-    for size, file_path in files_to_resize:
-      self.resize_image(file_path)
 
-    if len(only_extensions) > 0:
-        self.extensions = temp_extensions
+  def search_jpg_quality(self, image, initial_quality=90):
+    """Binary search (in memory) of the highest quality between min_quality and initial_quality
+    whose output is below threshold_kb. If no quality fits, min_quality is used. Returns [quality, jpg bytes]."""
+    best_quality = initial_quality
+    best_data = self.encode_image(image, "JPEG", optimize=True, quality=initial_quality)
 
+    if self.bytes_to_kb(len(best_data)) <= self.threshold_kb:
+      return [best_quality, best_data]
 
-  def resize_image(self, path_to_file):
-    """Calls resize function depending on file extension."""
-    if not self.valid_file(path_to_file):
-      print(f"Warning: file not valid {path_to_file}.")
-      return
+    low = self.min_quality
+    high = initial_quality - 1
+    fits = False
 
-    output, input = "", ""
+    while low <= high:
+      quality = (low + high) // 2
+      data = self.encode_image(image, "JPEG", optimize=True, quality=quality)
 
-    if self.file_extension(path_to_file) in [".jpg", ".jpeg", ".png"]:
-      output, input= self.resize_png_jpg(path_to_file)
+      if self.bytes_to_kb(len(data)) <= self.threshold_kb:
+        best_quality, best_data, fits = quality, data, True
+        low = quality + 1
+      else:
+        # Keep the smallest output while no quality fits.
+        if not fits:
+          best_quality, best_data = quality, data
+        high = quality - 1
 
-    if self.file_extension(path_to_file) in [".gif"]:
-      output, input = self.resize_gif(path_to_file)
+    return [best_quality, best_data]
 
-    self.display_result(output, input)
 
-  def resize_png_jpg(self, path_to_file):
+  def best_file(self, path_to_file):
+    """Decodes the image once, encodes every candidate version in memory and writes only the smallest one.
+    Returns [output, input], or None if file isn't valid."""
+    if not self.valid_file(path_to_file):
+      print(f"Warning: file not valid {path_to_file}.")
+      self.metric("skip_reason", "invalid")
+      return None
+
     if self.file_extension(path_to_file) not in [".jpg", ".jpeg", ".png"]:
-      print(f"Warning: invalid path for resize_png_jpg, {path_to_file}. Method will skip")
+      print(f"Warning: invalid path for best_file, {path_to_file}. Method will skip")
       return [path_to_file, path_to_file]
 
-    image = Image.open(path_to_file)
-    output_path = self.insert_prefix(self.output_resize_prefix, path_to_file)
+    output_path = self.insert_prefix(self.best_prefix, path_to_file)
 
-    # Avoid processing an image again.
     if os.path.exists(output_path):
-        return ["exists", output_path]
+      return ["exists", output_path]
 
-    is_png = self.file_extension(path_to_file) == ".png"
+    image = self.open_image(path_to_file)
 
-    resized_image = self.direct_resize(image, self.max_resize)
+    if not self.within_memory_limit(image, path_to_file):
+      return ["", path_to_file]
 
-    if is_png:
-      resized_image.save(output_path, optimize=True)
+    self.load_image(image)
+
+    if self.file_extension(path_to_file) == ".png":
+      candidates = self.png_candidates(image)
+    else:
+      candidates = self.jpg_candidates(image)
+
+    # Candidates are [name, data, size, options, image]
+    name, best_data, size, options, version = min(candidates, key=lambda candidate: len(candidate[1]))
+
+    if self.file_extension(path_to_file) == ".png":
+      best_data = self.lossless_stage(best_data, "PNG")
     else:
-      resized_image.save(output_path, quality=80, optimize=True)
+      best_data = self.lossless_stage(best_data, "JPEG", version, options["quality"])
+
+    self.metric("candidate", name)
+    for key, value in options.items():
+      self.metric(key, value)
+
+    self.write_file(output_path, best_data, size)
+    self.write_siblings(version, output_path)
 
     return [output_path, path_to_file]
 
 
-  def reduce_image(self, path_to_file):
+  def png_candidates(self, image):
+    """Encoded versions of a png: reduced and resized (same as reduce_png and resize_png_jpg),
+    each of them with and without quantizing. Returns a list of [name, data, size, options, image]."""
+    reduced = image
+    if self.resize:
+      reduced = self.reduce_dimensions(image)
+
+    resized = self.direct_resize(image, self.max_resize)
+
+    candidates = []
+    for name, version in [["reduce", reduced], ["resize", resized]]:
+      candidates.append([name, self.encode_image(version, "PNG", optimize=True), version.size, {}, version])
+
+      colors, quantized_data = self.encode_png(version)
+      candidates.append([name + "+quantize", quantized_data, version.size, {"colors": colors}, version])
+
+    return candidates
+
+
+  def jpg_candidates(self, image):
+    """Encoded versions of a jpg: reduced (same as reduce_jpg), resized (same as resize_png_jpg) and resized + reduced.
+    Returns a list of [name, data, size, options, image]."""
+    reduced = image
+    if self.resize:
+      reduced = self.reduce_dimensions(image)
+
+    resized = self.direct_resize(image, self.max_resize)
+
+    reduced_quality, reduced_data = self.encode_jpg(reduced)
+    resized_reduced_quality, resized_reduced_data = self.encode_jpg(resized)
+
+    return [
+      ["reduce", reduced_data, reduced.size, {"quality": reduced_quality}, reduced],
+      ["resize", self.encode_image(resized, "JPEG", quality=80, optimize=True), resized.size, {"quality": 80}, resized],
+      ["resize+reduce", resized_reduced_data, resized.size, {"quality": resized_reduced_quality}, resized],
+    ]
 
+
+  def srcset_file(self, path_to_file):
+    """Decodes the image once and writes each of srcset_widths narrower than it, resizing every width from the
+    previous (larger) one instead of from the original. Widths that already exist are not written again.
+    Returns [output of the largest width, input], or None if the file isn't valid or no width is narrower."""
     if not self.valid_file(path_to_file):
       print(f"Warning: file not valid {path_to_file}.")
-      return
+      self.metric("skip_reason", "invalid")
+      return None
 
-    output, input = "", ""
+    if self.file_extension(path_to_file) not in [".jpg", ".jpeg", ".png"]:
+      print(f"Warning: invalid path for srcset_file, {path_to_file}. Method will skip")
+      return [path_to_file, path_to_file]
 
-    if self.file_extension(path_to_file) in [".jpg", ".jpeg"]:
-      output, input= self.reduce_jpg(path_to_file)
-    elif self.file_extension(path_to_file) in [".png"]:
-      output, input = self.reduce_png(path_to_file)
-    elif self.file_extension(path_to_file) in [".gif"]:
-      output, input = self.reduce_gif(path_to_file)
+    image = self.open_image(path_to_file)
+    widths = sorted([width for width in set(self.srcset_widths) if width < image.width], reverse=True)
 
-    self.display_result(output, input)
+    if len(widths) == 0:
+      print(f"Info: image is narrower than every srcset width: {path_to_file}")
+      self.metric("skip_reason", "within limits")
+      return None
 
+    output_paths = [self.srcset_path(path_to_file, width) for width in widths]
+    if all(os.path.exists(output_path) for output_path in output_paths):
+      return ["exists", output_paths[0]]
 
-  def display_result(self, output, input):
-    if output == "" or input == "":
-      print(f"Info: file not processed {input}.")
-    elif output == "exists":
-      print(f"Info: skipping, file already exists {input}.")
-    else:
-      out_size = self.get_file_size_kb(output)
-      in_size = self.get_file_size_kb(input)
+    if not self.within_memory_limit(image, path_to_file, widths[0] / image.width):
+      return ["", path_to_file]
 
-      percentage = (out_size / in_size) * 100
-      print(f"[{round(100 - percentage, 2)}% reduction | {in_size} kb -> {out_size} kb: {output}]")
+    is_png = self.file_extension(path_to_file) == ".png"
+    sizes = [(width, max(1, round(image.height * width / image.width))) for width in widths]
+    srcset = {}
 
-      self.was_resized(output, input)
+    # Only the largest width is resized from the original, decoded at a reduced scale if it's a JPEG (see direct_resize).
+    image.draft(image.mode, sizes[0])
+    self.load_image(image)
+    version = image
 
-      if percentage == 100:
-        print(f"Warning: file size unchanged for {output}.")
-      if percentage > 100:
-        print(f"WARNING: file size INCREASED for {output}.")
-      if percentage < 100 and out_size > self.threshold_kb:
-        print(f"Warning: file size reduced but image remains above threshold for {output}.")
+    for width, size, output_path in zip(widths, sizes, output_paths):
+      version = version.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
 
-  def was_resized(self, output_path, input_file):
-    if os.path.basename(output_path).startswith(self.output_resize_prefix):
-        input_image = Image.open(input_file)
-        output_image = Image.open(output_path)
-        print(f"Output: {output_image.width} w {output_image.height} h, Input: {input_image.width} w {input_image.height} h")
+      if os.path.exists(output_path):
+        continue
 
+      if is_png:
+        data = self.encode_image(version, "PNG", optimize=True)
+      else:
+        data = self.encode_image(version, "JPEG", quality=80, optimize=True)
+        self.metric("quality", 80)
 
-  def reduce_png(self, path_to_file):
-    if self.file_extension(path_to_file) not in [".png"]:
-      print(f"Warning: invalid path for reduce_png, {path_to_file}. Method will skip")
-      return [path_to_file, path_to_file]
+      self.write_file(output_path, data, size)
+      self.write_siblings(version, output_path)
+      srcset[width] = len(data)
 
-    image = Image.open(path_to_file)
+    self.metric("srcset", srcset)
+    self.metric("output_width", sizes[0][0])
+    self.metric("output_height", sizes[0][1])
 
-    output_path = self.insert_prefix(self.output_reduce_prefix, path_to_file)
+    return [output_paths[0], path_to_file]
 
-    if os.path.exists(output_path):
-        return ["exists", output_path]
 
-    reduced_png = image.copy()
+  def srcset_path(self, path_to_file, width):
+    return self.insert_prefix(f"{self.srcset_prefix}{width}_", path_to_file)
 
-    if self.resize:
-      reduced_png = self.reduce_dimensions(reduced_png)
 
-    reduced_png = reduced_png.quantize(colors=self.colors_png) # https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.quantize
+  def srcset_attribute(self, path_to_file):
+    """Value for the srcset attribute of an <img> of path_to_file, with the versions generated by srcset_file
+    (basenames, as they are in the same folder)."""
+    candidates = []
+    for width in sorted(set(self.srcset_widths)):
+      output_path = self.srcset_path(path_to_file, width)
+      if os.path.exists(output_path):
+        candidates.append(f"{os.path.basename(output_path)} {width}w")
 
-    # PNG saving options: https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#png
-    reduced_png.save(output_path, optimize=True)
-    return [output_path, path_to_file]
+    return ", ".join(candidates)
 
 
-  def reduce_jpg(self, path_to_file):
-    if self.file_extension(path_to_file) not in [".jpg", ".jpeg"]:
-      print(f"Warning: invalid path for reduce_jpg, {path_to_file}. Method will skip")
-      return [path_to_file, path_to_file]
+  def lossless_stage(self, data, image_format, image=None, quality=None):
+    """Tries other encodings of data that keep the same pixels, until lossless_seconds (or the run deadline) is over,
+    and returns the smallest. PNGs are decoded from data and compressed with other zlib strategies. JPEGs are encoded
+    again from image with the same quality as progressive, which changes only how the coefficients are stored.
+    Metadata (exif, icc) is never copied to the outputs, so there is nothing else to strip."""
+    if self.lossless_seconds is None:
+      return data
 
-    image = Image.open(path_to_file)
+    start = time.perf_counter()
+    deadline = time.time() + self.lossless_seconds
+    if self.lossless_deadline is not None:
+      deadline = min(deadline, self.lossless_deadline)
 
-    reduced_jpg = image.copy()
+    if time.time() >= deadline:
+      self.metric("lossless", {"variant": None, "saved_bytes": 0, "seconds": 0.0})
+      return data
 
-    if self.resize:
-      reduced_jpg = self.reduce_dimensions(reduced_jpg)
+    if image_format == "PNG":
+      decoded = Image.open(io.BytesIO(data))
+      decoded.load()
+      # https://docs.python.org/3/library/zlib.html#zlib.compressobj (Z_FILTERED, Z_RLE)
+      variants = [["zlib filtered", lambda: self.encode_image(decoded, "PNG", optimize=True, compress_type=1)],
+                  ["zlib rle", lambda: self.encode_image(decoded, "PNG", optimize=True, compress_type=3)]]
+    else:
+      variants = [["progressive", lambda: self.encode_image(image, "JPEG", optimize=True, quality=quality, progressive=True)]]
 
-    # JPEG saving options: https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#jpeg-saving
+    original_size = len(data)
+    chosen = None
 
-    output_path = self.insert_prefix(self.output_reduce_prefix, path_to_file)
+    for name, encode in variants:
+      if time.time() >= deadline:
+        break
 
-    if os.path.exists(output_path):
-        return ["exists", output_path]
+      variant_data = encode()
+      if len(variant_data) < len(data):
+        data, chosen = variant_data, name
 
-    reduced_jpg.save(output_path)
+    self.metric("lossless", {"variant": chosen, "saved_bytes": original_size - len(data),
+                             "seconds": round(time.perf_counter() - start, 4)})
+    return data
 
-    initial_quality = 90
-    current_quality = initial_quality
-    quality_interval = int((initial_quality - self.min_quality) / 5) # Check 5 intervals
 
-    while self.get_file_size_kb(output_path) > self.threshold_kb and current_quality >= self.min_quality and quality_interval > 0:
-      reduce_iteration = reduced_jpg.copy()
+  def encode_image(self, image, image_format, **save_options):
+    """Saves image into a memory buffer instead of a file. Returns the encoded bytes."""
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **save_options)
+    self.add_seconds("encode_seconds", start)
+    return buffer.getvalue()
 
-      reduce_iteration.save(output_path, optimize=True, quality=current_quality)
-      current_quality -= quality_interval
 
-    return [output_path, path_to_file]
+  def open_image(self, path_to_file):
+    """Opens the image without decoding it, saving its dimensions in the metrics."""
+    image = Image.open(path_to_file)
+    self.metric("input_width", image.width)
+    self.metric("input_height", image.height)
+    return image
 
 
-  def reduce_dimensions(self, image):
-    """Reduces image to max dimensions. Maintains aspect ratio: considers only max_img_width_px or max_img_height_px."""
-    reduced_dim = image.copy()
+  def load_image(self, image):
+    """Decodes image (if it isn't decoded yet), measuring the time."""
+    start = time.perf_counter()
+    image.load()
+    self.add_seconds("decode_seconds", start)
+
+
+  def write_file(self, output_path, data, size):
+    """Writes encoded data to output_path. size are the dimensions of the encoded image."""
+    start = time.perf_counter()
+    with open(output_path, "wb") as output_file:
+      output_file.write(data)
 
+    self.add_seconds("write_seconds", start)
+    self.metric("output_width", size[0])
+    self.metric("output_height", size[1])
+
+
+  def reduce_dimensions(self, image):
+    """Reduces image to max dimensions. Maintains aspect ratio: considers only max_img_width_px or max_img_height_px.
+    image is not modified. If it isn't loaded yet, JPEGs are decoded at a reduced scale (see direct_resize)."""
     try:
-      if reduced_dim.width > self.max_img_width_px and self.max_img_width_px > 0:
-        width_reduction = self.max_img_width_px / image.width
-        return self.direct_resize(reduced_dim, width_reduction)
+      ratio = self.limit_ratio(image)
 
-      if reduced_dim.height > self.max_img_height_px and self.max_img_height_px > 0:
-        height_reduction = self.max_img_height_px / image.height
-        return self.direct_resize(reduced_dim, height_reduction)
+      if ratio is not None:
+        return self.direct_resize(image, ratio)
 
     except:
       print("Error: Some error happened during resizing.")
 
     print(f"Warning: reduce_dimensions didn't modify the image. original: width({image.width}), height ({image.height}). Max dimensions: width({self.max_img_width_px}), height ({self.max_img_height_px})")
-    return reduced_dim
+    return image
+
+
+  def limit_ratio(self, image):
+    """Ratio to reduce image to max dimensions, or None if it's within them."""
+    if image.width > self.max_img_width_px and self.max_img_width_px > 0:
+      return self.max_img_width_px / image.width
+
+    if image.height > self.max_img_height_px and self.max_img_height_px > 0:
+      return self.max_img_height_px / image.height
+
+    return None
+
+
+  def within_memory_limit(self, image, path_to_file, resize_ratio=None):
+    """Checks, before decoding, that image fits in max_image_mb. resize_ratio is the resize that will be
+    done right after opening it, which lets JPEGs be decoded at a reduced scale (see direct_resize)."""
+    if self.max_image_mb is None:
+      return True
+
+    size_mb = self.decoded_size_mb(image, resize_ratio)
+
+    if size_mb > self.max_image_mb:
+      print(f"Warning: decoded image would use {size_mb:.1f} mb (max_image_mb is {self.max_image_mb}). Skipping {path_to_file}.")
+      self.metric("skip_reason", "memory")
+      return False
+
+    return True
+
+
+  def decoded_size_mb(self, image, resize_ratio=None):
+    """Estimated memory of the decoded image, without decoding it."""
+    scale = 1
+
+    # Same scale that Image.draft chooses for JPEGs: 1/8, 1/4 or 1/2, keeping at least the new size.
+    if image.format == "JPEG" and resize_ratio is not None:
+      new_width = max(1, int(image.width * resize_ratio))
+      new_height = max(1, int(image.height * resize_ratio))
+      max_scale = min(image.width // new_width, image.height // new_height)
+
+      for draft_scale in [8, 4, 2, 1]:
+        if max_scale >= draft_scale:
+          scale = draft_scale
+          break
+
+    width = math.ceil(image.width / scale)
+    height = math.ceil(image.height / scale)
+    return width * height * len(image.getbands()) / (1024 * 1024)
 
 
   def reduce_gif(self, path_to_file):
@@ -309,49 +1964,78 @@ class ImageReduction:
 
 
   def resize_limit_gif(self, path_to_file, width, height):
-    c_prev = self.colors_
-    sc_prev = self.scale_ratio
-    lf_prev = self.lossiness_factor
+    """Resizes a gif to the limit dimensions. Returns [output, input], or None if it's within limits."""
+    scale_ratio = self.scale_ratio
 
     if width > self.max_img_width_px and self.max_img_width_px > 0:
         width_reduction = round(self.max_img_width_px / width, 1)
-        self.scale_ratio = str(width_reduction)
+        scale_ratio = str(width_reduction)
     elif height > self.max_img_height_px and self.max_img_height_px > 0:
         height_reduction = round(self.max_img_height_px / height, 1)
-        self.scale_ratio = str(width_reduction)
-        
-    if sc_prev != self.scale_ratio:
-      self.modify_gif_options(c_prev, self.scale_ratio, lf_prev)
-      self.resize_gif(path_to_file)
-    else:
-      print(f"Info: image is within specified limit dimensions: {path_to_file}")
+        scale_ratio = str(height_reduction)
 
-    self.modify_gif_options(c_prev, sc_prev, lf_prev)
+    if scale_ratio != self.scale_ratio:
+      output_path = self.insert_prefix(self.output_resize_prefix, path_to_file)
+      return self.modify_gif(path_to_file, output_path, change_scale=True, change_quality=False, scale_ratio=scale_ratio)
 
+    print(f"Info: image is within specified limit dimensions: {path_to_file}")
+    return None
 
-  def modify_gif(self, path_to_file, output_path, change_scale=False, change_quality=False):
-    options_string = ["--verbose"]
+
+  def modify_gif(self, path_to_file, output_path, change_scale=False, change_quality=False, scale_ratio=None):
+    """Runs gifsicle on path_to_file. scale_ratio overrides self.scale_ratio, so the
+    instance isn't modified and several gifs can be processed at the same time."""
 
     # Avoid processing an image again.
     if os.path.exists(output_path):
         return ["exists", output_path]
 
+    options = self.gif_options(change_scale, change_quality, scale_ratio)
+    self.metric("colors", self.colors_)
+
+    start = time.perf_counter()
+    returncode, output = self.run_gifsicle(path_to_file, output_path, options)
+    self.add_seconds("encode_seconds", start)
+
+    if returncode != 0:
+      print(f"Error: gifsicle failed for {path_to_file}:\n{output}")
+      return ["", path_to_file]
+
+    return [output_path, path_to_file]
+
+
+  def gif_options(self, change_scale=False, change_quality=False, scale_ratio=None):
+    """Returns the gifsicle options as a tuple, so they can't be changed while gifsicle runs."""
+    options = ["--optimize"]
+
     if change_quality:
-      options_string.append(f"--lossy={self.lossiness_factor}")
+      options.append(f"--lossy={self.lossiness_factor}")
 
     if change_scale:
-      scale_factor = f'{self.scale_ratio}x{self.scale_ratio}'
-      options_string.append(f"--scale={scale_factor}")
+      if scale_ratio is None:
+        scale_ratio = self.scale_ratio
+      options.append(f"--scale={scale_ratio}x{scale_ratio}")
 
-    pygifsicle.gifsicle(
-      sources=[path_to_file], # or a single_file.gif
-      destination=output_path, # or just omit it and will use the first source provided.
-      optimize=True, # Whetever to add the optimize flag of not
-      colors=self.colors_, # Number of colors to use
-      options=options_string # Options to use.
-    )
+    options += ["--colors", str(self.colors_)]
+    return tuple(options)
 
-    return [output_path, path_to_file]
+
+  def run_gifsicle(self, path_to_file, output_path, options):
+    """Same command as pygifsicle.gifsicle, but captures the output instead of printing it.
+    Saves the duration in gif_log. Returns [returncode, output]."""
+    command = ["gifsicle", *options, path_to_file, "--output", output_path]
+    start = time.perf_counter()
+
+    try:
+      completed = subprocess.run(command, capture_output=True, text=True)
+    except FileNotFoundError:
+      raise FileNotFoundError("gifsicle was not found on your system. See https://www.lcdf.org/gifsicle/")
+
+    seconds = time.perf_counter() - start
+    output = completed.stdout + completed.stderr
+
+    self.gif_log.append((path_to_file, seconds, completed.returncode, output))
+    return [completed.returncode, output]
 
 
   def over_dimensions(self, image):
@@ -361,8 +2045,16 @@ class ImageReduction:
   def direct_resize(self, image, ratio):
     new_width = int(image.width * ratio)
     new_height = int(image.height * ratio)
-    resized_image = image.resize((new_width, new_height))
+
+    # If image is a JPEG that hasn't been loaded, ask the decoder to scale it down (by 1/2, 1/4 or 1/8)
+    # while keeping it at least as big as the new size. Has no effect on other images.
+    # https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.draft
+    image.draft(image.mode, (new_width, new_height))
+    self.load_image(image)
+
+    # reducing_gap first reduces by an integer factor, then resamples the rest with LANCZOS.
     # See resampling filters: https://pillow.readthedocs.io/en/stable/handbook/concepts.html#PIL.Image.Resampling.LANCZOS
+    resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
     return resized_image
 
 
@@ -382,21 +2074,32 @@ class ImageReduction:
 
   def all_valid_files(self, path_to_directory, threshold_kb_=0):
     valid_files = []
-    for root, _, files in os.walk(path_to_directory):
-      for file in files:
-        file_path = os.path.join(root, file)
-
-        if not self.valid_file(file_path):
-          continue
+    for file_path, size, _ in self.get_snapshot(path_to_directory).files:
+      if not self.valid_file(file_path):
+        continue
 
-        size = self.get_file_size_kb(file_path)
-        if (size >= threshold_kb_):
-          valid_files.append((size, file_path))
+      if (size >= threshold_kb_):
+        valid_files.append((size, file_path))
 
     list.sort(valid_files, reverse=True)
     return valid_files
 
 
+  def get_snapshot(self, path_to_directory):
+    """Returns the DirectorySnapshot of path_to_directory, scanning it only if there isn't one already."""
+    key = os.path.abspath(path_to_directory)
+
+    if key not in self.snapshots:
+      self.snapshots[key] = DirectorySnapshot(path_to_directory, self)
+
+    return self.snapshots[key]
+
+
+  def clear_snapshots(self):
+    """Forces the next query to scan the directory again. Call it if files were changed outside of this class."""
+    self.snapshots = {}
+
+
   def print_files_above_threshold(self, path_to_directory):
     files_over_threshold = self.files_above_threshold(path_to_directory)
     for file in files_over_threshold:
@@ -405,16 +2108,12 @@ class ImageReduction:
 
   def generated_files(self, path_to_directory):
     generated_files = []
-    for root, _, files in os.walk(path_to_directory):
-      for file in files:
-        file_path = os.path.join(root, file)
-
-        if not self.valid_file(file_path):
-          continue
+    for file_path, size, original_name in self.get_snapshot(path_to_directory).files:
+      if not self.valid_file(file_path) and not self.is_sibling(file_path):
+        continue
 
-        if self.file_was_generated(file):
-          size = self.get_file_size_kb(file_path)
-          generated_files.append((size, file_path))
+      if original_name is not None:
+        generated_files.append((size, file_path))
 
     list.sort(generated_files, reverse=True)
     return generated_files
@@ -422,7 +2121,19 @@ class ImageReduction:
 
   def file_was_generated(self, path_to_file):
     file_basename = os.path.basename(path_to_file)
-    return file_basename.startswith(self.output_reduce_prefix) or file_basename.startswith(self.output_resize_prefix) or file_basename.startswith(self.best_prefix)
+    return (file_basename.startswith(self.output_reduce_prefix) or file_basename.startswith(self.output_resize_prefix)
+            or file_basename.startswith(self.best_prefix) or file_basename.startswith(self.srcset_prefix))
+
+
+  def is_sibling(self, path_to_file):
+    """True for files generated in one of modern_formats (see write_siblings)."""
+    return self.file_extension(path_to_file).lower() in self.modern_formats and self.file_was_generated(path_to_file)
+
+
+  def is_srcset(self, path_to_file):
+    """True for the versions written by srcset_file. They are smaller on purpose, so they don't compete with
+    the other generated files."""
+    return os.path.basename(path_to_file).startswith(self.srcset_prefix)
 
 
   def insert_prefix(self, prefix, path_to_file):
@@ -454,6 +2165,10 @@ class ImageReduction:
 
   def get_file_size_kb(self, file_path):
     size = os.path.getsize(file_path)
+    return self.bytes_to_kb(size)
+
+
+  def bytes_to_kb(self, size):
     return size // 1024  # bytes a kb
 
 
@@ -482,6 +2197,8 @@ class ImageReduction:
 
       print(f"Info: moved {file[1]} to {destination_path}.")
 
+    self.clear_snapshots()
+
 
   def is_contained(self, directory_path, file_path):
     directory_path = os.path.abspath(directory_path)
@@ -490,20 +2207,19 @@ class ImageReduction:
 
 
   def check_remaining_files(self, directory_path):
-    generated_files, original_files = self.generated_and_original(directory_path)
+    snapshot = self.get_snapshot(directory_path)
     original_set = set()
 
-    # Save original basenames of files that are above threshold.
-    for file in original_files:
-      if file[0] > self.threshold_kb:
-        original_set.add(os.path.basename(file[1]))
+    # Save original basenames of files that are above threshold and have no generated version below it.
+    for file_path, size, original_name in snapshot.files:
+      if original_name is not None or size <= self.threshold_kb or not self.valid_file(file_path):
+        continue
 
-    for file in generated_files:
-      if file[0] < self.threshold_kb:
-        original_name = self.trim_prefix(file[1])
+      basename = os.path.basename(file_path)
+      generated_versions = snapshot.generated_by_original.get(basename, [])
 
-        if original_name in original_set:
-          original_set.remove(original_name)
+      if not any(version[0] < self.threshold_kb and self.valid_file(version[1]) and not self.is_srcset(version[1]) for version in generated_versions):
+        original_set.add(basename)
 
     if len(original_set) == 0:
       print(f"There is at least one version of each file that is below {self.threshold_kb} kb.")
@@ -534,6 +2250,17 @@ class ImageReduction:
       return self.trim_prefix(basename[len(self.output_resize_prefix):])
     elif basename.startswith(self.best_prefix):
       return self.trim_prefix(basename[len(self.best_prefix):])
+    elif basename.startswith(self.srcset_prefix):
+      # Also removes the width: S_640_name -> name
+      width, _, name = basename[len(self.srcset_prefix):].partition("_")
+      if width.isdigit() and len(name) > 0:
+        return self.trim_prefix(name)
+      return self.trim_prefix(basename[len(self.srcset_prefix):])
+
+    # Siblings in modern formats belong to the file without the added extension.
+    name, ext = os.path.splitext(basename)
+    if ext.lower() in [".webp", ".avif"] and self.valid_file(name):
+      return name
 
     return basename
 
@@ -544,25 +2271,197 @@ class ImageReduction:
     self.lossiness_factor = lossiness_factor
 
 
-  # Only method that can remove files. Maintains original files.
+  # Only method that can remove files (besides watch_directory, for outdated outputs). Maintains original files.
   def save_only_smallest_modified_files(self, directory_path):
-    for root, _, files in os.walk(directory_path):
-      for file in files:
+    snapshot = self.get_snapshot(directory_path)
 
-        file_path = os.path.join(root, file)
+    # Sizes of the best files, updated in memory as files are moved.
+    best_sizes = {}
+    for file_path, size, _ in snapshot.files:
+      if os.path.basename(file_path).startswith(self.best_prefix):
+        best_sizes[file_path] = size
 
-        if not self.valid_file(file_path) or not self.file_was_generated(file_path):
-          continue
+    for file_path, size, original_name in snapshot.files:
+      if original_name is None or not self.valid_file(file_path) or self.is_srcset(file_path):
+        continue
 
-        original_path = os.path.join(root, self.trim_prefix(file_path))
+      original_path = os.path.join(os.path.dirname(file_path), original_name)
 
-        best_path = self.insert_prefix(self.best_prefix, original_path)
+      best_path = self.insert_prefix(self.best_prefix, original_path)
 
-        if not os.path.exists(best_path):
-          shutil.move(file_path, best_path)
-          continue
+      # Already the best version.
+      if file_path == best_path:
+        continue
+
+      # Siblings (see write_siblings) go with their file, and the ones of a replaced best file are removed.
+      if best_path not in best_sizes or size < best_sizes[best_path]:
+        shutil.move(file_path, best_path)
+        for ext in self.modern_formats:
+          if os.path.exists(file_path + ext):
+            shutil.move(file_path + ext, best_path + ext)
+          elif os.path.exists(best_path + ext):
+            os.remove(best_path + ext)
+        best_sizes[best_path] = size
+      else:
+        for path in [file_path] + [file_path + ext for ext in self.modern_formats]:
+          if os.path.exists(path):
+            os.remove(path)
+
+    self.clear_snapshots()
+
+
+class DirectorySnapshot:
+  """Files of a directory, scanned once with os.scandir. Keeps the size of each file and whether
+  it was generated by ImageReduction, so several queries don't need to walk the directory again."""
+
+  def __init__(self, path_to_directory, image_reduction):
+    self.path_to_directory = path_to_directory
+
+    # (file_path, size_kb, original_name). original_name is the basename without
+    # prefixes for generated files, and None for original files.
+    self.files = []
+
+    # original_name -> (size_kb, file_path) of the generated files of that original file.
+    self.generated_by_original = {}
+
+    self.scan(image_reduction)
+
+
+  def scan(self, image_reduction):
+    # Same order as os.walk: files of a directory, then its subdirectories.
+    directories = [self.path_to_directory]
+
+    while len(directories) > 0:
+      directory = directories.pop()
+      subdirectories = []
+
+      with os.scandir(directory) as entries:
+        for entry in entries:
+          if entry.is_dir() and not entry.is_symlink():
+            subdirectories.append(entry.path)
+          elif entry.is_file():
+            self.add_file(entry, image_reduction)
+
+      directories.extend(reversed(subdirectories))
+
+
+  def add_file(self, entry, image_reduction):
+    original_name = None
+    size = image_reduction.bytes_to_kb(entry.stat().st_size)
+
+    if image_reduction.file_was_generated(entry.name):
+      original_name = image_reduction.trim_prefix(entry.name)
+      self.generated_by_original.setdefault(original_name, []).append((size, entry.path))
+
+    self.files.append((entry.path, size, original_name))
+
+
+class DirectoryWatcher:
+  """Valid original files of a directory tree, with their size and modification time. poll() checks the
+  modification time of each directory and lists again only the ones that changed, so files that were added,
+  modified or removed are found without walking the whole tree."""
+
+  def __init__(self, path_to_directory, image_reduction):
+    self.image_reduction = image_reduction
+
+    # directory -> modification time (ns) when it was last listed.
+    self.directory_mtimes = {}
+
+    # directory -> {file_path: (size_bytes, mtime_ns)}
+    self.directory_files = {}
+
+    # file_path -> ((size_bytes, mtime_ns), time.monotonic() when it last changed, whether it existed before)
+    self.pending = {}
+
+    self.scan(path_to_directory, record_changes=False)
+
+
+  def poll(self, full_scan=False):
+    for directory in list(self.directory_mtimes):
+      if directory not in self.directory_mtimes:
+        continue
+
+      try:
+        mtime = os.stat(directory).st_mtime_ns
+      except FileNotFoundError:
+        self.forget(directory)
+        continue
+
+      if full_scan or mtime != self.directory_mtimes[directory]:
+        self.scan(directory)
+
+
+  def scan(self, directory, record_changes=True):
+    """Lists directory, recording new or changed files in pending. New subdirectories are scanned too."""
+    try:
+      self.directory_mtimes[directory] = os.stat(directory).st_mtime_ns
+      entries = list(os.scandir(directory))
+    except FileNotFoundError:
+      self.forget(directory)
+      return
+
+    previous_files = self.directory_files.get(directory, {})
+    files = {}
+
+    for entry in entries:
+      if entry.is_dir() and not entry.is_symlink():
+        if entry.path not in self.directory_mtimes:
+          self.scan(entry.path, record_changes)
+        continue
+
+      if not entry.is_file() or not self.watched(entry.path):
+        continue
+
+      stat = entry.stat()
+      signature = (stat.st_size, stat.st_mtime_ns)
+      files[entry.path] = signature
+
+      if record_changes and previous_files.get(entry.path) != signature:
+        self.pending[entry.path] = (signature, time.monotonic(), entry.path in previous_files)
+
+    for file_path in previous_files.keys() - files.keys():
+      self.pending.pop(file_path, None)
+
+    self.directory_files[directory] = files
+
+
+  def forget(self, directory):
+    """Removes a deleted directory (and its subdirectories)."""
+    for known in list(self.directory_mtimes):
+      if known == directory or known.startswith(directory + os.sep):
+        del self.directory_mtimes[known]
+
+        for file_path in self.directory_files.pop(known, {}):
+          self.pending.pop(file_path, None)
+
+
+  def watched(self, file_path):
+    image_reduction = self.image_reduction
+    return image_reduction.valid_file(file_path) and not image_reduction.file_was_generated(file_path)
+
+
+  def ready_files(self, debounce):
+    """Pending files that haven't changed for debounce seconds, as (size_kb, file_path, modified).
+    They are removed from pending."""
+    ready = []
+
+    for file_path, (signature, changed, modified) in list(self.pending.items()):
+      try:
+        stat = os.stat(file_path)
+      except FileNotFoundError:
+        del self.pending[file_path]
+        continue
+
+      current = (stat.st_size, stat.st_mtime_ns)
+
+      # Still being written.
+      if current != signature:
+        self.pending[file_path] = (current, time.monotonic(), modified)
+        continue
+
+      if time.monotonic() - changed >= debounce:
+        del self.pending[file_path]
+        self.directory_files.setdefault(os.path.dirname(file_path), {})[file_path] = current
+        ready.append((self.image_reduction.bytes_to_kb(current[0]), file_path, modified))
 
-        if self.get_file_size_kb(file_path) < self.get_file_size_kb(best_path):
-          shutil.move(file_path, best_path)
-        else:
-          os.remove(file_path)
\ No newline at end of file
+    return ready